@@ -1,4 +1,4 @@
-from flask import Flask, render_template, send_from_directory, request, url_for, redirect, jsonify, send_file
+from flask import Flask, render_template, send_from_directory, request, url_for, redirect, jsonify, send_file, Response, stream_with_context
 import os
 import random
 import base64
@@ -9,9 +9,25 @@ import shutil
 
 from flask_cors import CORS, cross_origin
 
-from settings.config import log_config, db_file, INPUT_IMAGE_FOLDER, SESSION_OUTPUT_FOLDER
+from settings.config import log_config, db_file, INPUT_IMAGE_FOLDER, SESSION_OUTPUT_FOLDER, PREFETCH_ENABLED, PREVIEW_PREGENERATE_AMOUNT, \
+    PREVIEW_WIDTH, PREVIEW_MAX_AGE_SECONDS, IMAGE_RESPONSE_MODE, EXPORT_MODE, METRICS_ENABLED, TIMING_HEADER_ENABLED, \
+    CLASSIFIER_WARMUP, DEDUP_ENABLED, DUPLICATE_LABEL_PROPAGATION, DUPLICATE_PROPAGATE_DISTANCE
 import db.db_funcs as dbf
-import classifier.classifier as clf
+from classifier.model_cache import model_cache
+from classifier.registry import model_registry
+from classifier.tensor_cache import tensor_cache
+from classifier.prefetcher import PredictionPrefetcher
+from classifier.training_jobs import TrainingJobManager
+from db.folder_indexer import FolderIndexer
+from preview.preview_cache import preview_cache, get_preview_mimetype
+from export.exporter import ExportManager, stream_archive
+import monitoring.metrics as metrics
+from dedup.duplicates import duplicate_index
+import atexit
+import multiprocessing
+import sys
+import threading
+import time
 
 # Logging setup
 import logging
@@ -27,62 +43,71 @@ CORS(app)
 dbf.initialize_db(db_file)
 # session_id = dbf.get_new_session_id(db_file)
 
+# Predictions are refilled in the background, the worker starts with the first image request
+prefetcher = PredictionPrefetcher(db_file)
+atexit.register(prefetcher.stop)
+
+# The input folder is indexed incrementally and watched in the background after the first refresh
+folder_indexer = FolderIndexer(db_file)
+atexit.register(folder_indexer.stop)
+
+# Labeled images are exported in background threads
+exports = ExportManager(db_file)
+
+# Models are trained in a separate process
+training_jobs = TrainingJobManager(db_file)
+atexit.register(training_jobs.shutdown)
+atexit.register(preview_cache.shutdown)
+
+
+def get_classifier():
+    # Tensorflow takes seconds and hundreds of MB to import, it's only loaded when a request needs it
+    import classifier.classifier as clf
+    return clf
+
+def warm_up_classifier():
+    start = time.time()
+    get_classifier()
+    logger.info(f'Classifier loaded in the background in {time.time() - start:.1f}s')
+
+# The spawned training processes import this module too, they load tensorflow anyway
+if CLASSIFIER_WARMUP and multiprocessing.parent_process() is None:
+    threading.Thread(target=warm_up_classifier, name='classifier-warm-up', daemon=True).start()
+
+
+# Request latency and stage timings, the hooks are only added when enabled
+if METRICS_ENABLED:
+    @app.before_request
+    def start_request_metrics():
+        metrics.start_request()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        timings = metrics.finish_request(request.endpoint or 'not_found', request.method, response.status_code)
+        if TIMING_HEADER_ENABLED and timings:
+            response.headers['Server-Timing'] = metrics.server_timing_header(timings)
+        return response
+
+    def collect_cache_counters(counter):
+        caches = {'model': model_cache.stats(), 'preview': preview_cache.stats(), 'tensor': tensor_cache.stats()}
+        if 'classifier.serving' in sys.modules: # Not imported yet means nothing was served
+            caches['serving'] = sys.modules['classifier.serving'].serving_cache.stats()
+        return [((cache,), stats.get(counter)) for cache, stats in caches.items()]
+
+    metrics.registry.register_collector('img_classifier_cache_hits_total', 'Hits of the in-memory and on-disk caches', 'counter',
+                                        ('cache',), lambda: collect_cache_counters('hits'))
+    metrics.registry.register_collector('img_classifier_cache_misses_total', 'Misses of the in-memory and on-disk caches', 'counter',
+                                        ('cache',), lambda: collect_cache_counters('misses'))
+    metrics.registry.register_collector('img_classifier_prediction_queue', 'Predictions waiting to be labeled per prefetched session', 'gauge',
+                                        ('session',), lambda: [((session_id,), state['queue_depth'])
+                                                               for session_id, state in prefetcher.status()['sessions'].items()])
 
-def initialize_images_in_db():
-    accepted_extensions = ['.apng', '.avif', '.gif', '.jpg', '.jpeg', '.jfif', '.pjpeg', '.pjp', '.png', '.svg', '.webp', '.bmp']
-    images = os.listdir(INPUT_IMAGE_FOLDER)
-    images = [i for i in images if os.path.splitext(i)[1].lower() in accepted_extensions] # Filter out non-image files
-    images_set = set(images)
-
-    images = list(images_set) # Remove duplicates
-
-    # Set values not available
-    dbf.set_not_available(db_file)
-
-    # Get list of sessions
-    sessions = dbf.get_sessions(db_file)
-
-    for session in sessions:
-        dbf.update_session_labeled_count(db_file, session['session_id'])
-        simgs = dbf.get_img_names_from_session(db_file, session['session_id'])
-        simgs_set = set(simgs)
-
-        qty_imgs = len(images_set)
-        qty_session_imgs = len(simgs_set)
-
-        if qty_imgs == qty_session_imgs:
-            if images_set == simgs_set:
-                # All images in folder are already in the database.
-                session['imgs_are_available'] = True
-                dbf.set_session_imgs_available(db_file, session['session_id'])
-                continue
-
-        qty_diff = qty_imgs - qty_session_imgs
-        if qty_diff > 0:
-            # There are more images in the folder than in the session in db
-            diff_imgs = images_set.difference(simgs_set)
-
-            if qty_diff != len(diff_imgs):
-                # All images in the database are not in the folder
-                continue
-            # There are more images in folder but the old ones are still there, so it's safe to add the new ones 
-            dbf.initialize_images_session(db_file, list(diff_imgs),session['session_id'])
-            session['imgs_are_available'] = True
-            dbf.set_session_imgs_available(db_file, session['session_id'])
-            dbf.update_session_labeled_count(db_file, session['session_id'])
-            continue
-        else:
-            # Some images in the database are not in the folder
-            continue
-        
-    
-    if any([session['imgs_are_available'] for session in sessions]):
-        # At least one session exists with all images available
-        return
 
-    new_session_id = dbf.new_session(db_file, len(images), 0, True)
-    dbf.initialize_images_session(db_file, images, new_session_id)
-    return
+def initialize_images_in_db(force=False):
+    # Only rescans the input folder when it changed, the sessions are updated from the file index
+    folder_indexer.refresh(force=force)
+    # Keeps watching the folder from the process serving requests
+    folder_indexer.start()
 
 @app.route('/')
 def index(): 
@@ -102,14 +127,15 @@ def random_image64():
     if not session_id:
         return jsonify({"success":False, "info": "No session ID received"})
     
-    filename, encoded_string, predicted_label = get_next_image_data(session_id)
+    image_mode = request.args.get('imageMode', IMAGE_RESPONSE_MODE)
+    filename, encoded_string, predicted_label = get_next_image_data(session_id, image_mode=image_mode)
     stats = dbf.get_stats_from_session(db_file, session_id)
 
     if not filename and not encoded_string:
         errored_images = dbf.get_errored_images_by_session(db_file, session_id)
         return jsonify({"success":False, "info": "No unlabeled images left", "stats":stats, "errored_images":errored_images})
 
-    return jsonify({"success":True, "image":encoded_string , "filename":filename, "info": "OK", "stats":stats, "predicted": predicted_label})
+    return jsonify({"success":True, image_response_key(image_mode):encoded_string , "filename":filename, "info": "OK", "stats":stats, "predicted": predicted_label})
 
 
 @app.route('/api/tag_img_get_new', methods=['POST'])
@@ -120,19 +146,26 @@ def tag_img_get_new():
     filename = content['filename']
     session_id = content['sessionId']
     print(f"Tagging image {filename} as {label}")
-    dbf.update_image_label(db_file, session_id, filename, label)
-    dbf.set_prediction_processed(db_file,filename, session_id)
-    labeled_count, total_count = dbf.update_session_labeled_count(db_file, session_id)
+    with dbf.transaction(db_file):
+        dbf.update_image_label(db_file, session_id, filename, label)
+        dbf.set_prediction_processed(db_file,filename, session_id)
+        if DEDUP_ENABLED and DUPLICATE_LABEL_PROPAGATION:
+            # The unlabeled duplicates of the image get the same label
+            duplicates = duplicate_index.find_duplicates(filename, max_distance=DUPLICATE_PROPAGATE_DISTANCE)
+            if duplicates:
+                dbf.label_unlabeled_images(db_file, session_id, duplicates, label)
+        labeled_count, total_count = dbf.update_session_labeled_count(db_file, session_id)
     
     # Get a new image
-    filename, encoded_string, predicted_label = get_next_image_data(session_id)
+    image_mode = content.get('imageMode', IMAGE_RESPONSE_MODE)
+    filename, encoded_string, predicted_label = get_next_image_data(session_id, image_mode=image_mode)
     stats = dbf.get_stats_from_session(db_file, session_id)
     
     if not filename and not encoded_string:
         errored_images = dbf.get_errored_images_by_session(db_file, session_id)
         return jsonify({"success":False, "info": "No unlabeled images left", "stats":stats, "errored_images":errored_images})
         
-    return jsonify({"success":True, "image":encoded_string , "filename":filename, "info": "OK", "stats":stats, "predicted": predicted_label})
+    return jsonify({"success":True, image_response_key(image_mode):encoded_string , "filename":filename, "info": "OK", "stats":stats, "predicted": predicted_label})
 
 @app.route('/api/get_img_by_filename', methods=['POST'])
 def get_img_by_filename():
@@ -142,43 +175,76 @@ def get_img_by_filename():
     session_id = content['sessionId']
     
     # Get selected image
-    filename, encoded_string, predicted_label = get_next_image_data(session_id, filename=filename)
+    image_mode = content.get('imageMode', IMAGE_RESPONSE_MODE)
+    filename, encoded_string, predicted_label = get_next_image_data(session_id, filename=filename, image_mode=image_mode)
     stats = dbf.get_stats_from_session(db_file, session_id)
     
     if not filename and not encoded_string:
         errored_images = dbf.get_errored_images_by_session(db_file, session_id)
         return jsonify({"success":False, "info": "No unlabeled images left", "stats":stats, "errored_images":errored_images})
         
-    return jsonify({"success":True, "image":encoded_string , "filename":filename, "info": "OK", "stats":stats, "predicted": predicted_label})
+    return jsonify({"success":True, image_response_key(image_mode):encoded_string , "filename":filename, "info": "OK", "stats":stats, "predicted": predicted_label})
 
 
 def get_response_scaled_image(image_path):
-    pil_img = Image.open(image_path, mode='r') # reads the PIL image
-    img_format = pil_img.format
+    img_bytes, img_format = preview_cache.get(image_path)
+    with metrics.span('base64'):
+        encoded_img = base64.b64encode(img_bytes).decode('ascii') # encode as base64, without newlines
+    return encoded_img
 
-    base_width = 1000
-    wpercent = (base_width / float(pil_img.size[0]))
-    hsize = int((float(pil_img.size[1]) * float(wpercent)))
-    pil_img = pil_img.resize((base_width, hsize), Image.Resampling.LANCZOS)
 
+def get_preview_url(image_path, filename):
+    # The version changes with the file, so the browser can cache each url forever
+    stat = os.stat(image_path)
+    return url_for('preview_image', filename=filename, v=f'{stat.st_mtime_ns}-{stat.st_size}', _external=True)
 
-    byte_arr = io.BytesIO()
-    pil_img.save(byte_arr, format=img_format) # convert the PIL image to byte array
 
-    encoded_img = base64.encodebytes(byte_arr.getvalue()).decode('ascii') # encode as base64
-    return encoded_img
+def image_response_key(image_mode):
+    return "imageUrl" if image_mode == 'url' else "image"
+
+
+@app.route('/api/preview')
+def preview_image():
+    filename = request.args.get('filename')
+    if not filename or os.path.basename(filename) != filename:
+        return jsonify({"success":False, "info": "Invalid filename"}), 400
+    image_path = INPUT_IMAGE_FOLDER + '/' + filename
+    if not os.path.exists(image_path):
+        return jsonify({"success":False, "info": "Image not found"}), 404
+
+    stat = os.stat(image_path)
+    preview_path, img_format = preview_cache.get_path(image_path)
+    etag = f'{stat.st_mtime_ns}-{stat.st_size}-{PREVIEW_WIDTH}'
+    # Answers with 304 when the browser sends a matching If-None-Match or If-Modified-Since
+    response = send_file(preview_path, mimetype=get_preview_mimetype(img_format), conditional=True, etag=etag,
+                         last_modified=stat.st_mtime, max_age=PREVIEW_MAX_AGE_SECONDS)
+    if request.args.get('v'):
+        # Versioned urls never change their content
+        response.cache_control.immutable = True
+    return response
+
+
+def pregenerate_next_previews(session_id):
+    # The next images of the prediction queue will likely be requested soon
+    if PREVIEW_PREGENERATE_AMOUNT <= 0:
+        return
+    next_images = dbf.get_next_unprocessed_predictions(db_file, session_id, PREVIEW_PREGENERATE_AMOUNT + 1)
+    preview_cache.pregenerate([INPUT_IMAGE_FOLDER + '/' + name for name in next_images])
 
 
-def get_next_image_data(session_id, filename=None):
+def get_next_image_data(session_id, filename=None, image_mode='base64'):
     can_predict_images = True # Assumes there are images to predict
     predicted_label = None
     if not filename:
         # If there isnt a specific image to fetch
         filename, predicted_label = dbf.get_unprocessed_prediction(db_file, session_id)
+        if PREFETCH_ENABLED:
+            # Let the worker top up the queue before it runs dry
+            prefetcher.touch(session_id)
 
     if not filename:
         # generate new batch of predictions
-        can_predict_images = clf.predict_images(session_id=session_id, image_amount=50)
+        can_predict_images = prefetcher.refill(session_id, image_amount=50)
         filename, predicted_label = dbf.get_unprocessed_prediction(db_file, session_id)
     
     if not filename:
@@ -190,7 +256,12 @@ def get_next_image_data(session_id, filename=None):
         return None, None, None
     
     image = INPUT_IMAGE_FOLDER + '/' + filename
-    encoded_string = get_response_scaled_image(image)
+    if image_mode == 'url':
+        # The browser fetches the preview from /api/preview
+        encoded_string = get_preview_url(image, filename)
+    else:
+        encoded_string = get_response_scaled_image(image)
+    pregenerate_next_previews(session_id)
 
     return filename, encoded_string, predicted_label
 
@@ -202,34 +273,38 @@ def copy_imgs_to_new_folder():
     session_id = request.args.get('session')
     if not session_id:
         return jsonify({"success":False, "info": "No session ID received"})
-    
-    imgs_list = dbf.get_imgs_from_session(db_file, session_id)
-
-    img_classes = dbf.get_image_classes(db_file, session_id)
-
-    # Check if output folder exists
-    if not os.path.exists(SESSION_OUTPUT_FOLDER):
-        os.makedirs(SESSION_OUTPUT_FOLDER)
-
-    # Create subfolder with session id and create it if it doesn't exist
-    output_folder = SESSION_OUTPUT_FOLDER + '/S' + session_id
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
 
-    # Create subfolders for each class
-    for img_class in img_classes:
-        if not os.path.exists(output_folder + '/' + img_class):
-            os.makedirs(output_folder + '/' + img_class)
-
-    for image in imgs_list:
-        if image['label']:
-            # check if metadata file exists in input folder
-            if os.path.exists(INPUT_IMAGE_FOLDER + '/' + image['name'] + '.json'):
-                shutil.copy2(INPUT_IMAGE_FOLDER + '/' + image['name'] + '.json', output_folder + '/' +  image['label'] + '/' + image['name'] + '.json')
-
-            shutil.copy2(INPUT_IMAGE_FOLDER + '/' + image['name'], output_folder + '/' +  image['label'] + '/' + image['name'])
+    # The images are exported in the background, only new or changed files are copied
+    mode = request.args.get('mode', EXPORT_MODE)
+    try:
+        job_id = exports.submit(int(session_id), mode=mode)
+    except ValueError as e:
+        return jsonify({"success":False, "info": str(e)})
+    return jsonify({"success":True, "info": "Export started", "jobId": job_id})
+
+@app.route('/api/export_status')
+def export_status():
+    job_id = request.args.get('job')
+    if not job_id:
+        return jsonify({"success":False, "info": "No job ID received"})
+    progress = exports.status(int(job_id))
+    if not progress:
+        return jsonify({"success":False, "info": "Export not found"})
+    return jsonify({"success":True, "data":progress, "info": "OK"})
+
+@app.route('/api/export_archive')
+def export_archive():
+    session_id = request.args.get('session')
+    if not session_id:
+        return jsonify({"success":False, "info": "No session ID received"})
+    archive_format = request.args.get('format', 'tar')
+    if archive_format not in ('tar', 'zip'):
+        return jsonify({"success":False, "info": "Unknown archive format"})
 
-    return jsonify({"success":True,  "info": "Done :)"})
+    # The archive is built while it's being downloaded
+    mimetype = 'application/zip' if archive_format == 'zip' else 'application/x-tar'
+    return Response(stream_with_context(stream_archive(db_file, int(session_id), archive_format)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=S{session_id}.{archive_format}'})
 
 @app.route('/api/get_available_sessions')
 # @cross_origin()
@@ -243,19 +318,116 @@ def train_model():
     content = request.get_json()
     session_id = content['sessionId']
     full_train = content['fullTrain']
+    mode = 'head' if content.get('headOnly') else 'model'
     if not session_id:
         return jsonify({"success":False, "info": "No session ID received"})
 
     try:
-        clf.train_model_by_session(db_file, session_id, full_train=full_train)
+        job_id = training_jobs.submit(session_id, full_train=full_train, mode=mode)
     except ValueError as e:
         return jsonify({"success":False, "info": str(e)})
-    return jsonify({"success":True, "info": "OK"})
+    return jsonify({"success":True, "info": "Training started", "jobId": job_id})
+
+@app.route('/api/train_status')
+def train_status():
+    job_id = request.args.get('job')
+    if not job_id:
+        return jsonify({"success":False, "info": "No job ID received"})
+    job = training_jobs.status(int(job_id))
+    if not job:
+        return jsonify({"success":False, "info": "Job not found"})
+    return jsonify({"success":True, "data":job, "info": "OK"})
+
+@app.route('/api/train_jobs')
+def train_jobs():
+    session_id = request.args.get('session')
+    jobs = dbf.get_training_jobs(db_file, session_id=session_id)
+    return jsonify({"success":True, "data":jobs, "info": "OK"})
+
+@app.route('/api/cancel_train', methods=['POST'])
+def cancel_train():
+    content = request.get_json()
+    job_id = content['jobId']
+    if not training_jobs.cancel(int(job_id)):
+        return jsonify({"success":False, "info": "Job is not running"})
+    return jsonify({"success":True, "info": "Cancelled"})
+
+@app.route('/api/resume_train', methods=['POST'])
+def resume_train():
+    content = request.get_json()
+    job_id = content['jobId']
+    try:
+        new_job_id = training_jobs.resume(int(job_id))
+    except ValueError as e:
+        return jsonify({"success":False, "info": str(e)})
+    return jsonify({"success":True, "info": "Training resumed", "jobId": new_job_id})
+
+@app.route('/api/model_cache_stats')
+def model_cache_stats():
+    return jsonify({"success":True, "data":model_cache.stats(), "info": "OK"})
+
+@app.route('/api/metrics')
+def metrics_endpoint():
+    if not METRICS_ENABLED:
+        return jsonify({"success":False, "info": "Metrics are disabled"}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/duplicates')
+def duplicates():
+    filename = request.args.get('filename')
+    if not filename:
+        return jsonify({"success":True, "data":duplicate_index.stats(), "info": "OK"})
+    return jsonify({"success":True, "data":duplicate_index.find_duplicates(filename), "info": "OK"})
+
+@app.route('/api/serving_status')
+def serving_status():
+    session_id = request.args.get('session')
+    if not session_id:
+        return jsonify({"success":False, "info": "No session ID received"})
+    return jsonify({"success":True, "data":get_classifier().get_serving_status(int(session_id)), "info": "OK"})
+
+@app.route('/api/model_versions')
+def model_versions():
+    session_id = request.args.get('session')
+    if not session_id:
+        return jsonify({"success":False, "info": "No session ID received"})
+    if 'classifier.classifier' in sys.modules: # Only then this process predicts with a version
+        data = sys.modules['classifier.classifier'].get_model_versions(int(session_id))
+    else:
+        data = model_registry.status(int(session_id))
+    return jsonify({"success":True, "data":data, "info": "OK"})
+
+@app.route('/api/pin_model', methods=['POST'])
+def pin_model():
+    """
+    Pin a version of the session model with {"sessionId", "version"}, roll back to the previous one with
+    {"sessionId", "rollback": true} or serve the latest one again with {"sessionId", "unpin": true}.
+    """
+    content = request.get_json()
+    session_id = content.get('sessionId')
+    if not session_id:
+        return jsonify({"success":False, "info": "No session ID received"})
+    try:
+        if content.get('unpin'):
+            model_registry.unpin(int(session_id))
+        elif content.get('rollback'):
+            model_registry.rollback(int(session_id))
+        else:
+            model_registry.pin(int(session_id), int(content['version']))
+    except (ValueError, KeyError) as e:
+        return jsonify({"success":False, "info": str(e)})
+    return jsonify({"success":True, "data":model_registry.status(int(session_id)), "info": "OK"})
+
+@app.route('/api/prefetch_status')
+def prefetch_status():
+    data = prefetcher.status()
+    data['enabled'] = PREFETCH_ENABLED
+    return jsonify({"success":True, "data":data, "info": "OK"})
 
 @app.route('/api/refresh_image_init_data')
 def refresh_image_init_data():
     try:
-        initialize_images_in_db()
+        initialize_images_in_db(force=True)
     except Exception as e:
         return jsonify({"success":False, "info": str(e)})
     return jsonify({"success":True, "info": "OK"})
@@ -0,0 +1,230 @@
+"""
+Benchmarks of the hot paths on a synthetic input folder and database.
+
+    python -m benchmarks.run --images 10000 --sessions 5 --output bench.json
+    python -m benchmarks.run --images 10000 --sessions 5 --baseline bench.json
+
+The settings are read when the app modules are imported, so they are only imported after pointing
+VOLUME_PATH to the benchmark folder.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import generate_images, populate_database, synthetic_label
+
+BENCHMARKS = ['index', 'tag_round_trip', 'unprocessed_prediction', 'predict', 'train_epoch', 'preview', 'export']
+
+
+def measure(fn, repeat: int) -> dict:
+    """
+    Call fn repeat times and get the latency distribution in ms.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return {'mean_ms': round(float(np.mean(times)), 3), 'p50_ms': round(float(np.percentile(times, 50)), 3),
+            'p95_ms': round(float(np.percentile(times, 95)), 3), 'calls': repeat}
+
+
+def bench_index(args) -> dict:
+    import app as server
+    start = time.perf_counter()
+    server.initialize_images_in_db(force=True)
+    cold_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    server.initialize_images_in_db(force=True)
+    rescan_seconds = time.perf_counter() - start
+    unchanged = measure(server.initialize_images_in_db, args.repeat)
+    return {'cold_seconds': round(cold_seconds, 3), 'rescan_seconds': round(rescan_seconds, 3), 'unchanged_p50_ms': unchanged['p50_ms'],
+            'images_per_second': round(args.images / cold_seconds, 1)}
+
+def bench_tag_round_trip(args) -> dict:
+    import app as server
+    from settings.config import db_file
+    import db.db_funcs as dbf
+    client = server.app.test_client()
+    session_id = args.session_ids[-1] # Has a prediction queue and no model, like a new session
+
+    def tag_one():
+        filename = dbf.obtain_random_unlabeled_image(db_file, session_id)
+        response = client.post('/api/tag_img_get_new', json={'imgType': synthetic_label(filename, args.classes), 'filename': filename,
+                                                             'sessionId': session_id, 'imageMode': 'url'})
+        assert response.status_code == 200
+    return measure(tag_one, args.repeat)
+
+def bench_unprocessed_prediction(args) -> dict:
+    from settings.config import db_file
+    import db.db_funcs as dbf
+    session_id = args.session_ids[-1]
+    results = measure(lambda: dbf.get_unprocessed_prediction(db_file, session_id), args.repeat)
+    results['queue_length'] = dbf.count_unprocessed_predictions(db_file, session_id)
+    return results
+
+def bench_predict(args) -> dict:
+    import classifier.classifier as clf
+    session_id = args.session_ids[0]
+    # An untrained model predicts as fast as a trained one
+    model = clf.get_or_create_model(session_id, args.classes)
+    clf.save_model(model, session_id, {i: f'class_{i}' for i in range(args.classes)})
+
+    clf.predict_images(session_id, clf.predict_batch_size) # Loads the model and builds the graph
+    start = time.perf_counter()
+    clf.predict_images(session_id, args.predict_images)
+    seconds = time.perf_counter() - start
+    return {'seconds': round(seconds, 3), 'images': args.predict_images, 'images_per_second': round(args.predict_images / seconds, 1)}
+
+def bench_train_epoch(args) -> dict:
+    import tensorflow as tf
+    import classifier.classifier as clf
+    from settings.config import db_file
+
+    class FirstEpoch(tf.keras.callbacks.Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.seconds = time.perf_counter() - self.start
+            self.model.stop_training = True
+
+    first_epoch = FirstEpoch()
+    clf.train_model_by_session(db_file, args.session_ids[0], full_train=True, callbacks=[first_epoch])
+    return {'epoch_seconds': round(first_epoch.seconds, 3), 'images': args.labeled,
+            'images_per_second': round(args.labeled / first_epoch.seconds, 1)}
+
+def bench_preview(args) -> dict:
+    from preview.preview_cache import create_preview, preview_cache
+    from settings.config import INPUT_IMAGE_FOLDER
+    paths = [f'{INPUT_IMAGE_FOLDER}/img_{i:07d}.jpg' for i in range(args.repeat)]
+    paths_iter = iter(paths)
+    encode = measure(lambda: create_preview(next(paths_iter)), len(paths))
+    for path in paths:
+        preview_cache.get(path)
+    paths_iter = iter(paths)
+    cached = measure(lambda: preview_cache.get(next(paths_iter)), len(paths))
+    return {'encode_p50_ms': encode['p50_ms'], 'encode_p95_ms': encode['p95_ms'], 'cached_p50_ms': cached['p50_ms'],
+            'images_per_second': round(1000 / encode['mean_ms'], 1)}
+
+def bench_export(args) -> dict:
+    from export.exporter import ExportJob
+    from settings.config import db_file
+    results = {}
+    for run in ['cold', 'incremental']:
+        job = ExportJob(0, db_file, args.session_ids[0], mode=args.export_mode)
+        job.run()
+        progress = job.progress()
+        results[f'{run}_seconds'] = progress['seconds']
+        if run == 'cold':
+            results['files'] = progress['total']
+            results['files_per_second'] = round(progress['total'] / progress['seconds'], 1) if progress['seconds'] else None
+    return results
+
+
+def is_lower_better(metric: str):
+    """
+    Direction of a metric from its name, None for metrics that are only informative.
+    """
+    if metric.endswith('_seconds') or metric.endswith('_ms'):
+        return True
+    if metric.endswith('_per_second'):
+        return False
+    return None
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float) -> list[dict]:
+    """
+    Get the metrics that got worse than the baseline by more than tolerance (relative).
+    """
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            base_value = baseline.get('results', {}).get(name, {}).get(metric)
+            lower_better = is_lower_better(metric)
+            if lower_better is None or not isinstance(value, (int, float)) or not isinstance(base_value, (int, float)) or not base_value:
+                continue
+            change = (value - base_value) / base_value
+            if (change > tolerance) if lower_better else (change < -tolerance):
+                regressions.append({'benchmark': name, 'metric': metric, 'baseline': base_value, 'value': value,
+                                    'change': round(change, 4)})
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic data')
+    parser.add_argument('--workdir', help='Empty folder for the synthetic data, a temporary folder by default')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folder')
+    parser.add_argument('--images', type=int, default=10000)
+    parser.add_argument('--sessions', type=int, default=5)
+    parser.add_argument('--classes', type=int, default=4)
+    parser.add_argument('--labeled', type=int, default=512, help='Labeled images of each session, used to train')
+    parser.add_argument('--predictions', type=int, default=2000, help='Queued predictions of each session')
+    parser.add_argument('--predict-images', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=50, help='Calls of the latency benchmarks')
+    parser.add_argument('--export-mode', default='copy')
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='Comma separated benchmarks to run, index always runs')
+    parser.add_argument('--output', help='Write the results to this json file')
+    parser.add_argument('--baseline', help='Compare with the results in this json file')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='Relative change counted as a regression')
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='img_classifier_bench_')
+    volume_path = os.path.abspath(workdir) + '/'
+    if os.path.exists(volume_path + 'data/db.sqlite3'):
+        parser.error(f'{workdir} already has a database, use an empty folder')
+    for folder in ['data/images/input', 'data/images/output', 'data/models']:
+        os.makedirs(volume_path + folder, exist_ok=True)
+    os.environ.update({'PRODUCTION': 'True', 'VOLUME_PATH': volume_path, 'INDEX_POLL_SECONDS': '0', 'PREFETCH_ENABLED': 'False',
+                       'SERVING_EXPORT_FORMATS': ''})
+
+    start = time.perf_counter()
+    generate_images(volume_path + 'data/images/input', args.images, classes=args.classes)
+    generate_seconds = time.perf_counter() - start
+
+    selected = ['index'] + [name for name in args.only.split(',') if name != 'index']
+    results = {}
+    for name in selected:
+        if name not in BENCHMARKS:
+            parser.error(f'Unknown benchmark: {name}')
+        print(f'Running {name}...', file=sys.stderr)
+        try:
+            results[name] = globals()[f'bench_{name}'](args)
+        except Exception as e:
+            if name == 'index':
+                raise
+            results[name] = {'error': repr(e)}
+        if name == 'index':
+            from settings.config import db_file
+            args.session_ids = populate_database(db_file, args.sessions, args.labeled, args.predictions, args.classes)
+
+    report = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'python': platform.python_version(),
+                       'platform': platform.platform(), 'cpus': os.cpu_count(), 'images': args.images, 'sessions': args.sessions,
+                       'classes': args.classes, 'labeled': args.labeled, 'predictions': args.predictions,
+                       'generate_seconds': round(generate_seconds, 3)},
+              'results': results}
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_to_baseline(results, json.load(f), args.tolerance)
+        report['regressions'] = regressions
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    import db.db_funcs as dbf
+    dbf.close_connections()
+    if not args.workdir and not args.keep:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+"""
+Startup time and memory of the server module, with the classifier loaded lazily and eagerly.
+
+    python -m benchmarks.startup --repeat 3
+
+Each measurement imports app.py in a new process pointed to an empty temporary folder.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Run in the child process: time the import of app.py, optionally followed by the classifier like before,
+# and report the peak resident memory
+CHILD_CODE = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import app
+if sys.argv[1] == 'eager':
+    import classifier.classifier
+seconds = time.perf_counter() - start
+max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({'import_seconds': seconds, 'max_rss_mb': max_rss_kb / 1024, 'tensorflow_loaded': 'tensorflow' in sys.modules}))
+'''
+
+
+def measure_startup(mode: str, repeat: int) -> dict:
+    """
+    Import the server module repeat times in new processes and get the best import time and the peak memory.
+    """
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory(prefix='img_classifier_startup_') as workdir:
+            os.makedirs(os.path.join(workdir, 'data'))
+            env = dict(os.environ, PRODUCTION='True', VOLUME_PATH=workdir + '/', CLASSIFIER_WARMUP='False')
+            output = subprocess.run([sys.executable, '-c', CHILD_CODE, mode], env=env, capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {'import_seconds': round(min(run['import_seconds'] for run in runs), 3),
+            'max_rss_mb': round(max(run['max_rss_mb'] for run in runs), 1),
+            'tensorflow_loaded': runs[0]['tensorflow_loaded']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup time and memory of the server')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    results = {mode: measure_startup(mode, args.repeat) for mode in ['lazy', 'eager']}
+    results['saved_seconds'] = round(results['eager']['import_seconds'] - results['lazy']['import_seconds'], 3)
+    results['saved_rss_mb'] = round(results['eager']['max_rss_mb'] - results['lazy']['max_rss_mb'], 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
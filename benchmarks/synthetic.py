@@ -0,0 +1,74 @@
+import os
+import shutil
+import sqlite3
+
+import numpy as np
+from PIL import Image
+
+
+def synthetic_label(image_name: str, classes: int) -> str:
+    """
+    Get the class of a synthetic image from its name.
+    """
+    return f'class_{int(os.path.splitext(image_name)[0].split("_")[1]) % classes}'
+
+def _create_pool_image(path: str, class_index: int, classes: int, size: tuple[int, int], rng: np.random.Generator):
+    # Each class has its own base color so a model can learn something, noise makes the files differ
+    hue = np.array([class_index * 255 // classes, 255 - class_index * 255 // classes, (class_index * 97) % 256], dtype=np.float32)
+    noise = rng.normal(0, 40, (size[1], size[0], 3))
+    pixels = np.clip(hue + noise, 0, 255).astype(np.uint8)
+    Image.fromarray(pixels).save(path, format='JPEG', quality=90)
+
+def generate_images(folder: str, amount: int, classes: int = 4, pool_size: int = 64, size: tuple[int, int] = (1600, 1200),
+                    seed: int = 0) -> list[str]:
+    """
+    Fill the folder with amount synthetic JPEG images. Only pool_size different files are encoded,
+    the other images are hardlinks (or copies) of them, so large folders are generated quickly.
+    Return the image names.
+    """
+    rng = np.random.default_rng(seed)
+    pool_size = max(classes, pool_size - pool_size % classes) # Image i has the class of pool image i % pool_size
+    pool_folder = os.path.join(os.path.dirname(os.path.abspath(folder)), 'pool')
+    os.makedirs(pool_folder, exist_ok=True)
+    os.makedirs(folder, exist_ok=True)
+    pool = []
+    for i in range(pool_size):
+        pool_path = os.path.join(pool_folder, f'pool_{i}.jpg')
+        if not os.path.exists(pool_path):
+            _create_pool_image(pool_path, i % classes, classes, size, rng)
+        pool.append(pool_path)
+
+    names = []
+    for i in range(amount):
+        name = f'img_{i:07d}.jpg'
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            try:
+                os.link(pool[i % pool_size], path)
+            except OSError:
+                shutil.copyfile(pool[i % pool_size], path)
+        names.append(name)
+    return names
+
+def populate_database(db_filepath: str, sessions: int, labeled: int, predictions: int, classes: int):
+    """
+    Copy the images of session 1 into sessions-1 more sessions, label the first labeled images of every session
+    and queue predictions for the next predictions unlabeled images.
+    Uses plain sqlite so it can be filled at scale, the triggers keep the counters up to date.
+    """
+    connection = sqlite3.connect(db_filepath)
+    with connection:
+        names = [row[0] for row in connection.execute('SELECT name FROM image WHERE session_id = 1 ORDER BY name')]
+        for _ in range(sessions - 1):
+            cursor = connection.execute('INSERT INTO session(completed, last_updated, imgs_are_available, img_total, img_processed) VALUES (0, CURRENT_TIMESTAMP, 0, 0, 0)')
+            connection.execute('INSERT INTO image(name, session_id, processed, label) SELECT name, ?, 0, NULL FROM image WHERE session_id = 1',
+                               (cursor.lastrowid,))
+
+        session_ids = [row[0] for row in connection.execute('SELECT session_id FROM session ORDER BY session_id')]
+        for session_id in session_ids:
+            connection.executemany('UPDATE image SET label = ? WHERE session_id = ? AND name = ?',
+                                   [(synthetic_label(name, classes), session_id, name) for name in names[:labeled]])
+            connection.executemany('INSERT INTO prediction(name, label, processed, session_id) VALUES (?, ?, 0, ?)',
+                                   [(name, synthetic_label(name, classes), session_id) for name in names[labeled:labeled + predictions]])
+    connection.close()
+    return session_ids
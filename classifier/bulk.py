@@ -0,0 +1,203 @@
+"""
+Classify every unlabeled image of a session from the command line, without the UI.
+
+    python -m classifier.bulk --session 3 --workers 8 --write-folders
+
+Images are decoded by a pool of processes into batches in shared memory, and the model of the session runs over
+each batch in this process. Predictions are stored in bulk, an interrupted run continues where it stopped because
+images that already have a prediction of the model version are skipped.
+"""
+import argparse
+import json
+import os
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+from settings.config import log_config, db_file, INPUT_IMAGE_FOLDER, SESSION_OUTPUT_FOLDER, PREDICT_BATCH_SIZE, TENSOR_CACHE_ENABLED, \
+    EXPORT_MODE, EXPORT_WORKERS
+import db.db_funcs as dbf
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+IMAGE_SHAPE = (256, 256, 3)
+
+# Shared memory of the decoding worker processes
+_shm = None
+_slots = None
+
+
+def _init_worker(shm_name: str, slot_count: int, batch_size: int):
+    global _shm, _slots
+    import tensorflow as tf
+    # Each process decodes one image at a time, the pool gives the parallelism
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    _slots = np.ndarray((slot_count, batch_size, *IMAGE_SHAPE), dtype=np.uint8, buffer=_shm.buf)
+
+def _decode_batch(slot: int, image_names: list[str]) -> tuple[int, list[str], list[tuple[str, str]]]:
+    """
+    Decode the images into a slot of the shared memory. Return the slot, the decoded names and the failed ones.
+    """
+    import classifier.classifier as clf
+    from classifier.tensor_cache import tensor_cache
+    decoded = []
+    failed = []
+    for image_name in image_names:
+        image_path = INPUT_IMAGE_FOLDER + '/' + image_name
+        try:
+            if TENSOR_CACHE_ENABLED:
+                image = tensor_cache.get_or_create(image_path, clf.decode_and_resize_uint8)
+            else:
+                image = clf.decode_and_resize_uint8(image_path)
+            _slots[slot, len(decoded)] = image
+            decoded.append(image_name)
+        except Exception as _:
+            failed.append((image_name, traceback.format_exc()))
+    return slot, decoded, failed
+
+
+class BulkClassifier:
+    """
+    Runs the model of a session over all of its unlabeled images that have no pending prediction.
+    """
+
+    def __init__(self, session_id: int, workers: int = None, batch_size: int = PREDICT_BATCH_SIZE, commit_every: int = 1000,
+                 write_folders: bool = False, export_mode: str = EXPORT_MODE, limit: int = None, report_seconds: float = 10):
+        self.session_id = session_id
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.commit_every = commit_every
+        self.write_folders = write_folders
+        self.export_mode = export_mode
+        self.limit = limit
+        self.report_seconds = report_seconds
+        self.output_folder = SESSION_OUTPUT_FOLDER + '/S' + str(session_id)
+        self.model_version = None
+
+        self.total = 0
+        self.predicted = 0
+        self.failed = 0
+        self.label_counts = {}
+        self._pending_predictions = []
+        self._pending_failures = []
+
+    def run(self) -> dict:
+        import classifier.classifier as clf
+        from export.exporter import export_file
+        predictor, map_index_to_label, self.model_version = clf.get_session_predictor(self.session_id)
+        if predictor is None:
+            raise ValueError(f"No model to classify session {self.session_id}")
+
+        image_names = dbf.obtain_unpredicted_images_from_session(db_file, self.session_id, self.model_version)
+        if self.limit:
+            image_names = image_names[:self.limit]
+        self.total = len(image_names)
+        logger.info(f'Classifying {self.total} images of session {self.session_id} with {self.workers} decoding processes')
+        batches = iter([image_names[i:i + self.batch_size] for i in range(0, len(image_names), self.batch_size)])
+
+        # Two slots per worker, so every worker has a batch to decode while the model runs
+        slot_count = self.workers * 2
+        slot_bytes = self.batch_size * int(np.prod(IMAGE_SHAPE))
+        shm = shared_memory.SharedMemory(create=True, size=slot_count * slot_bytes)
+        slots = np.ndarray((slot_count, self.batch_size, *IMAGE_SHAPE), dtype=np.uint8, buffer=shm.buf)
+        free_slots = deque(range(slot_count))
+        self._export_pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS) if self.write_folders else None
+        self._export_file = export_file
+
+        start = time.time()
+        last_report = (start, 0)
+        try:
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context('spawn'), initializer=_init_worker,
+                                     initargs=(shm.name, slot_count, self.batch_size)) as executor:
+                pending = set()
+
+                def submit_next():
+                    batch = next(batches, None)
+                    if batch is not None:
+                        pending.add(executor.submit(_decode_batch, free_slots.popleft(), batch))
+
+                for _ in range(slot_count):
+                    submit_next()
+
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        slot, decoded, failed = future.result()
+                        if decoded:
+                            images = slots[slot, :len(decoded)].astype(np.float32) / 255.0 # Copied, the slot can be reused
+                        free_slots.append(slot)
+                        submit_next()
+
+                        if decoded:
+                            label_indexes = np.argmax(predictor(images), axis=1)
+                            self._pending_predictions.extend((name, map_index_to_label[int(i)]) for name, i in zip(decoded, label_indexes))
+                        self._pending_failures.extend(failed)
+                        if len(self._pending_predictions) + len(self._pending_failures) >= self.commit_every:
+                            self._flush()
+
+                    now = time.time()
+                    if now - last_report[0] >= self.report_seconds:
+                        done_count = self.predicted + self.failed + len(self._pending_predictions) + len(self._pending_failures)
+                        rate = (done_count - last_report[1]) / (now - last_report[0])
+                        logger.info(f'{done_count}/{self.total} images, {rate:.1f} images/s')
+                        last_report = (now, done_count)
+        except KeyboardInterrupt:
+            logger.info('Interrupted, saving the predictions made so far. Run again to continue.')
+        finally:
+            self._flush()
+            if self._export_pool is not None:
+                self._export_pool.shutdown()
+            del slots
+            shm.close()
+            shm.unlink()
+
+        seconds = time.time() - start
+        summary = {'session_id': self.session_id, 'total': self.total, 'predicted': self.predicted, 'failed': self.failed,
+                   'seconds': round(seconds, 2), 'images_per_second': round((self.predicted + self.failed) / seconds, 1) if seconds else None,
+                   'labels': self.label_counts, 'model_version': self.model_version, 'workers': self.workers, 'batch_size': self.batch_size}
+        logger.info(f'Bulk classification finished: {json.dumps(summary)}')
+        return summary
+
+    def _flush(self):
+        predictions, self._pending_predictions = self._pending_predictions, []
+        failures, self._pending_failures = self._pending_failures, []
+        if not predictions and not failures:
+            return
+        with dbf.transaction(db_file):
+            dbf.add_predictions(db_file, predictions, self.session_id, self.model_version)
+            for image_name, tb in failures:
+                dbf.new_exc_error(db_file, self.session_id, tb, INPUT_IMAGE_FOLDER + '/' + image_name)
+        self.predicted += len(predictions)
+        self.failed += len(failures)
+        for _, label in predictions:
+            self.label_counts[label] = self.label_counts.get(label, 0) + 1
+
+        if self._export_pool is not None:
+            for label in set(label for _, label in predictions):
+                os.makedirs(self.output_folder + '/' + label, exist_ok=True)
+            list(self._export_pool.map(lambda p: self._export_file(INPUT_IMAGE_FOLDER + '/' + p[0], self.output_folder + '/' + p[1] + '/' + p[0],
+                                                                   self.export_mode), predictions))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Classify the unlabeled images of a session with its model')
+    parser.add_argument('--session', type=int, required=True)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Decoding processes')
+    parser.add_argument('--batch-size', type=int, default=PREDICT_BATCH_SIZE)
+    parser.add_argument('--commit-every', type=int, default=1000, help='Predictions stored per transaction')
+    parser.add_argument('--write-folders', action='store_true', help='Also write the images to SESSION_OUTPUT_FOLDER/S<session>/<label>')
+    parser.add_argument('--export-mode', default=EXPORT_MODE, help='copy, hardlink or reflink, used with --write-folders')
+    parser.add_argument('--limit', type=int, help='Classify at most this many images')
+    args = parser.parse_args()
+    dbf.initialize_db(db_file)
+    bulk = BulkClassifier(args.session, workers=args.workers, batch_size=args.batch_size, commit_every=args.commit_every,
+                          write_folders=args.write_folders, export_mode=args.export_mode, limit=args.limit)
+    print(json.dumps(bulk.run(), indent=2))
@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import tensorflow as tf
+from settings.config import log_config, EARLY_STOPPING_MONITOR, EARLY_STOPPING_PATIENCE, EARLY_STOPPING_MIN_DELTA
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    """
+    Add the wall time of each epoch to its logs, so it's in the history next to the metrics.
+    """
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None:
+            logs['epoch_seconds'] = time.perf_counter() - self.epoch_start
+
+
+class BestWeightsEarlyStopping(tf.keras.callbacks.EarlyStopping):
+    """
+    Early stopping that can continue from the state of an interrupted training, and ends with the best weights
+    even when it didn't stop early (keras only restores them when it stops).
+    """
+
+    def __init__(self, resume_state: dict = None, monitor: str = EARLY_STOPPING_MONITOR, patience: int = EARLY_STOPPING_PATIENCE,
+                 min_delta: float = EARLY_STOPPING_MIN_DELTA):
+        super().__init__(monitor=monitor, patience=patience, min_delta=min_delta, restore_best_weights=True, verbose=1)
+        self.resume_state = resume_state
+
+    def on_train_begin(self, logs=None):
+        super().on_train_begin(logs)
+        if self.resume_state:
+            self.wait = self.resume_state['wait']
+            self.best = self.resume_state['best']
+            self.best_epoch = self.resume_state['best_epoch']
+            self.best_weights = self.resume_state.get('best_weights')
+
+    def on_train_end(self, logs=None):
+        super().on_train_end(logs)
+        if self.stopped_epoch == 0 and self.best_weights is not None:
+            logger.info(f'Restoring the weights of the best epoch: {self.best_epoch + 1}')
+            self.model.set_weights(self.best_weights)
+
+    def state(self) -> dict:
+        return {'wait': self.wait, 'best': float(self.best), 'best_epoch': self.best_epoch}
+
+
+class TrainingCheckpoint(tf.keras.callbacks.Callback):
+    """
+    Save the model, the best weights and the early stopping state after every epoch, replacing the previous files
+    atomically. The signature identifies the training data, a checkpoint is only resumed for the same data.
+    """
+
+    def __init__(self, folder: str, signature: str, early_stopping: BestWeightsEarlyStopping):
+        super().__init__()
+        self.folder = folder
+        self.signature = signature
+        self.early_stopping = early_stopping
+
+    def on_epoch_end(self, epoch, logs=None):
+        os.makedirs(self.folder, exist_ok=True)
+        self.model.save(os.path.join(self.folder, 'last.tmp.h5'), overwrite=True)
+        os.replace(os.path.join(self.folder, 'last.tmp.h5'), os.path.join(self.folder, 'last.h5'))
+        if self.early_stopping.best_epoch == epoch:
+            with open(os.path.join(self.folder, 'best_weights.tmp.npz'), 'wb') as f:
+                np.savez(f, *self.early_stopping.best_weights)
+            os.replace(os.path.join(self.folder, 'best_weights.tmp.npz'), os.path.join(self.folder, 'best_weights.npz'))
+
+        state = {'signature': self.signature, 'epoch': epoch, 'early_stopping': self.early_stopping.state()}
+        with open(os.path.join(self.folder, 'state.tmp.json'), 'w') as f:
+            json.dump(state, f)
+        os.replace(os.path.join(self.folder, 'state.tmp.json'), os.path.join(self.folder, 'state.json'))
+
+
+def load_checkpoint(folder: str, signature: str):
+    """
+    Load the checkpoint of an interrupted training with the same signature.
+    Return the model, the epoch to continue from and the early stopping state, or None if there is no checkpoint.
+    Checkpoints of other trainings are removed.
+    """
+    try:
+        with open(os.path.join(folder, 'state.json')) as f:
+            state = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if state.get('signature') != signature:
+        logger.info(f'Removing the checkpoint of a different training: {folder}')
+        clear_checkpoint(folder)
+        return None
+
+    model = tf.keras.models.load_model(os.path.join(folder, 'last.h5'))
+    resume_state = dict(state['early_stopping'])
+    try:
+        with np.load(os.path.join(folder, 'best_weights.npz')) as best_weights:
+            resume_state['best_weights'] = [best_weights[f'arr_{i}'] for i in range(len(best_weights.files))]
+    except FileNotFoundError:
+        pass
+    logger.info(f'Resuming training from the checkpoint of epoch {state["epoch"] + 1}: {folder}')
+    return model, state['epoch'] + 1, resume_state
+
+def clear_checkpoint(folder: str):
+    """
+    Remove the checkpoint of a training, once its model is saved.
+    """
+    shutil.rmtree(folder, ignore_errors=True)
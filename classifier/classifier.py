@@ -1,10 +1,23 @@
 import tensorflow as tf
 import numpy as np
 import os
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-from settings.config import log_config, db_file, INPUT_IMAGE_FOLDER, CLS_MODEL_FOLDER
+import random
+import time
+import hashlib
+import glob
+import json
+import threading
+from settings.config import log_config, db_file, INPUT_IMAGE_FOLDER, CLS_MODEL_FOLDER, PREDICT_BATCH_SIZE, TENSOR_CACHE_ENABLED, \
+    TRAIN_DATASET_CACHE, TRAIN_VALIDATION_SPLIT, TRAIN_SEED, REPLAY_BUFFER_SIZE, INCREMENTAL_EPOCHS, SERVING_EXPORT_FORMATS, DEDUP_ENABLED, TRAIN_DEDUPLICATE, \
+    TRAIN_MAX_EPOCHS, TRAIN_MEMORY_CACHE_MAX_IMAGES
 import db.db_funcs as dbf
+from classifier.model_cache import model_cache
+from classifier.tensor_cache import tensor_cache
+from monitoring.metrics import span, inc, predictions_total, decode_failures_total
+from classifier.serving import get_predictor, get_serving_report, select_serving_format, export_serving_artifacts
+from classifier.registry import model_registry
+from classifier.training_jobs import get_checkpoint_folder
+from classifier.checkpoints import EpochTimer, BestWeightsEarlyStopping, TrainingCheckpoint, load_checkpoint, clear_checkpoint
 
 import logging
 from logging import config as logging_config
@@ -13,13 +26,27 @@ logging_config.dictConfig(log_config)
 logger = logging.getLogger()
 
 batch_size = 32
+predict_batch_size = PREDICT_BATCH_SIZE
 
-def get_or_create_model(session_id: int, number_of_classes: int) -> tf.keras.models.Sequential:
+def get_current_model(session_id: int):
     """
-    Get the model from the file system or create a new one.
+    Get the file and the label map of the model version served for the session, or of the model saved
+    before the registry existed. Return None, None if the session has no model.
     """
+    version = model_registry.current_version(session_id)
+    if version is not None:
+        return model_registry.model_path(session_id, version), model_registry.get_label_map(session_id, version)
     model_file = CLS_MODEL_FOLDER + f'/model_{session_id}.h5'
     if os.path.exists(model_file):
+        return model_file, dbf.get_label_map(db_file, session_id)
+    return None, None
+
+def get_or_create_model(session_id: int, number_of_classes: int) -> tf.keras.models.Sequential:
+    """
+    Get the model from the file system or create a new one.
+    """
+    model_file, _ = get_current_model(session_id)
+    if model_file is not None:
         model = tf.keras.models.load_model(model_file)
     else:
         model = model = tf.keras.models.Sequential([
@@ -44,19 +71,56 @@ def get_or_create_model(session_id: int, number_of_classes: int) -> tf.keras.mod
     # TODO: Create a pretrained model to initialize if desired
     return model
 
-def save_model(model: tf.keras.models.Sequential, session_id: int):
+def expand_output_layer(model: tf.keras.Model, number_of_classes: int) -> tf.keras.Model:
     """
-    Save the model to the file system.
+    Replace the output layer with a bigger one when classes are added. The weights of the existing classes are kept,
+    so their index and what the model learnt about them don't change.
     """
-    model_file = CLS_MODEL_FOLDER + f'/model_{session_id}.h5'
-    model.save(model_file, overwrite=True)
+    output_layer = model.layers[-1]
+    old_number_of_classes = output_layer.units
+    if number_of_classes <= old_number_of_classes:
+        return model
+
+    new_output_layer = tf.keras.layers.Dense(number_of_classes, activation='softmax')
+    outputs = new_output_layer(model.layers[-2].output)
+    kernel, bias = output_layer.get_weights()
+    new_kernel, new_bias = new_output_layer.get_weights()
+    new_kernel[:, :old_number_of_classes] = kernel
+    new_bias[:old_number_of_classes] = bias
+    new_output_layer.set_weights([new_kernel, new_bias])
+
+    expanded_model = tf.keras.Model(model.inputs, outputs)
+    expanded_model.compile(loss = 'categorical_crossentropy', optimizer='rmsprop', metrics=['accuracy'])
+    logger.info(f'Output layer expanded from {old_number_of_classes} to {number_of_classes} classes')
+    return expanded_model
+
+def save_model(model: tf.keras.models.Sequential, session_id: int, map_index_to_label: dict[int, str] = None, metadata: dict = None) -> int:
+    """
+    Publish the model and its label map as a new version of the session in the registry, with its serving artifacts.
+    Servers switch to it on their next prediction. Return the version.
+    """
+    if map_index_to_label is None:
+        map_index_to_label = dbf.get_label_map(db_file, session_id)
+
+    def write_artifacts(folder):
+        model_filepath = os.path.join(folder, 'model.h5')
+        model.save(model_filepath)
+        if SERVING_EXPORT_FORMATS:
+            try:
+                export_serving_artifacts(model, session_id, model_filepath=model_filepath, map_index_to_label=map_index_to_label)
+            except Exception as _:
+                # Predictions fall back to the keras model
+                logger.error(f'Could not export the serving artifacts of session {session_id}', exc_info=True)
 
+    return model_registry.publish(session_id, write_artifacts, map_index_to_label, metadata)
 
-def fine_tune_model(model: tf.keras.models.Sequential, train, val, epochs=25):
+
+def fine_tune_model(model: tf.keras.models.Sequential, train, val, epochs=TRAIN_MAX_EPOCHS, callbacks=None, initial_epoch=0):
     """
     Fine tune the model with the given data.
+    epochs is the last epoch, training continues from initial_epoch when resumed.
     """
-    history = model.fit(train, epochs=epochs, validation_data = val, verbose = 1)
+    history = model.fit(train, epochs=epochs, validation_data = val, verbose = 1, callbacks=callbacks, initial_epoch=initial_epoch)
     return model, history
 
 
@@ -71,126 +135,352 @@ def extract_labels_and_mappings(data_list: list[dict]) -> tuple[list[str], int,
     map_label_to_categorical = {label: tf.keras.utils.to_categorical(index, num_classes=len(class_names)) for index, label in map_index_to_label.items()}
     return class_names, number_of_classes, map_label_to_index, map_index_to_label, map_label_to_categorical
 
-def load_image(filename, label):
+def extend_label_mappings(map_index_to_label: dict[int, str], data_list: list[dict]) -> tuple[list[str], int, dict[str, int], dict[int, str], dict[str, np.ndarray]]:
     """
-    Load and preprocess each image.
+    Same as extract_labels_and_mappings, but keeping the index of the labels already known by the model.
+    New labels get the next indexes.
+    """
+    map_index_to_label = dict(map_index_to_label or {})
+    known_labels = set(map_index_to_label.values())
+    for label in sorted(set(item["class"] for item in data_list) - known_labels):
+        map_index_to_label[len(map_index_to_label)] = label
+    class_names = [map_index_to_label[index] for index in sorted(map_index_to_label)]
+    number_of_classes = len(class_names)
+    map_label_to_index = {label: index for index, label in map_index_to_label.items()}
+    map_label_to_categorical = {label: tf.keras.utils.to_categorical(index, num_classes=number_of_classes) for index, label in map_index_to_label.items()}
+    return class_names, number_of_classes, map_label_to_index, map_index_to_label, map_label_to_categorical
+
+def sample_replay_buffer(data_list: list[dict], size: int = REPLAY_BUFFER_SIZE, seed: int = TRAIN_SEED) -> list[dict]:
+    """
+    Random sample of up to size images with the same amount of each class where possible.
+    The share of classes with fewer images goes to the others.
+    """
+    items_by_class = {}
+    for item in data_list:
+        items_by_class.setdefault(item["class"], []).append(item)
+    rng = random.Random(seed)
+    for items in items_by_class.values():
+        rng.shuffle(items)
+
+    sample = []
+    remaining = size
+    # Smallest classes first, so what they can't use is shared by the bigger ones
+    classes = sorted(items_by_class, key=lambda label: len(items_by_class[label]))
+    for position, label in enumerate(classes):
+        quota = remaining // (len(classes) - position)
+        taken = items_by_class[label][:quota]
+        sample.extend(taken)
+        remaining -= len(taken)
+    return sample
+
+def decode_and_resize(filename):
+    """
+    Read an image file and resize it to the model input size.
     """
     image = tf.io.read_file(filename)
     image = tf.image.decode_image(image, channels=3, expand_animations = False)
     image = tf.image.resize(image, [256, 256])
-    return image, label
+    return image
+
+def decode_and_resize_uint8(filename) -> np.ndarray:
+    """
+    Decode and resize an image to the uint8 array stored in the tensor cache.
+    """
+    # Same as decode_and_resize, run eagerly so each stage can be timed
+    with span('decode'):
+        image = tf.image.decode_image(tf.io.read_file(filename), channels=3, expand_animations = False)
+    with span('resize'):
+        image = tf.image.resize(image, [256, 256])
+    return tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8).numpy()
+
+def load_cached_image_uint8(filename):
+    """
+    Load the resized uint8 image from the tensor cache, decoding and caching it if needed. Works inside tf.data.
+    """
+    if not TENSOR_CACHE_ENABLED:
+        return tf.cast(tf.clip_by_value(tf.round(decode_and_resize(filename)), 0, 255), tf.uint8)
+
+    def load(filename_tensor):
+        image_path = filename_tensor.numpy().decode('utf-8')
+        return tensor_cache.get_or_create(image_path, decode_and_resize_uint8)
 
-def create_dataset(data_list: list[dict]) -> tf.data.Dataset:   
+    image = tf.py_function(load, [filename], tf.uint8)
+    image.set_shape([256, 256, 3])
+    return image
+
+def load_cached_image(filename):
+    """
+    Same as load_cached_image_uint8, as float32 in [0, 255].
+    """
+    return tf.cast(load_cached_image_uint8(filename), tf.float32)
+
+def load_image(filename, label):
+    """
+    Load each image as uint8, so the dataset cache holds a quarter of the float32 size.
+    """
+    return load_cached_image_uint8(filename), label
+
+def create_dataset(data_list: list[dict], shuffle: bool = False, cache: str = '', seed: int = TRAIN_SEED) -> tf.data.Dataset:
     """
-    Create a dataset from the data list.
+    Create a batched and scaled dataset from the data list.
+    Images are loaded in parallel and prefetched while the model trains on the previous batch.
+    cache can be '' (no cache), 'memory' or a file path prefix, the cache is filled during the first epoch.
     """
     filenames = [item['filename'] for item in data_list]
-    # print(filenames)
     labels = [item['label'] for item in data_list]
-    
+
     # Create a dataset from the filenames and labels
     dataset = tf.data.Dataset.from_tensor_slices((filenames, labels))
-    
+
     # Map the process_image function to each element
-    dataset = dataset.map(load_image)
-    
+    dataset = dataset.map(load_image, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache == 'memory':
+        dataset = dataset.cache()
+    elif cache:
+        dataset = dataset.cache(cache)
+
+    if shuffle:
+        # Reshuffled each epoch, but reproducible for the same seed
+        dataset = dataset.shuffle(len(filenames), seed=seed, reshuffle_each_iteration=True)
+
+    dataset = dataset.batch(batch_size)
+    # Scale data, after the cache
+    dataset = dataset.map(lambda x, y: (tf.cast(x, tf.float32) / 255.0, y), num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    return dataset
+
+def split_data_list(data_list: list[dict], validation_split: float = TRAIN_VALIDATION_SPLIT, seed: int = TRAIN_SEED) -> tuple[list[dict], list[dict]]:
+    """
+    Shuffle the samples with the given seed and split them into train and validation lists.
+    """
+    data_list = list(data_list)
+    random.Random(seed).shuffle(data_list)
+    val_size = int(validation_split * len(data_list)) or 1
+    return data_list[val_size:], data_list[:val_size]
+
+
+class InputPipelineMonitor(tf.keras.callbacks.Callback):
+    """
+    Estimate how long each epoch waited on the input pipeline.
+    With prefetching a step that didn't wait takes only the compute time, so the time a step took over
+    the fastest step of the epoch is counted as input stall.
+    """
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.step_times = []
+        self.epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step_times.append(time.perf_counter() - self.step_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        # The first step of the first epoch includes tracing the model, leave it out
+        step_times = self.step_times[1:] if epoch == 0 and len(self.step_times) > 1 else self.step_times
+        if not step_times:
+            return
+        fastest_step = min(step_times)
+        stall_seconds = sum(step - fastest_step for step in step_times)
+        train_seconds = sum(step_times)
+        stall_ratio = stall_seconds / train_seconds if train_seconds else 0
+        logger.info(f"Epoch {epoch + 1}: {time.perf_counter() - self.epoch_start:.2f}s, {train_seconds / len(step_times) * 1000:.1f} ms/step, "
+                    f"input stall {stall_seconds:.2f}s ({stall_ratio:.0%}), {'input bound' if stall_ratio > 0.3 else 'compute bound'}")
+        if logs is not None:
+            logs['input_stall_seconds'] = stall_seconds
+            logs['input_stall_ratio'] = stall_ratio
+
+
+def create_prediction_dataset(image_names: list[str]) -> tf.data.Dataset:
+    """
+    Create a batched dataset of (name, scaled image) to run predictions on.
+    Images that can't be read or decoded are dropped from the dataset.
+    """
+    def load_scaled_image(name):
+        image = load_cached_image(tf.strings.join([INPUT_IMAGE_FOLDER + '/', name]))
+        return name, image / 255.0
+
+    dataset = tf.data.Dataset.from_tensor_slices(image_names)
+    dataset = dataset.map(load_scaled_image, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.apply(tf.data.experimental.ignore_errors())
+    dataset = dataset.batch(predict_batch_size)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
     return dataset
 
-def train_model_by_session(db_file, session_id, full_train=False):
+def deduplicate_data_list(data_list: list[dict]) -> list[dict]:
+    """
+    Keep a single image of each group of near duplicates with the same label.
+    """
+    from dedup.duplicates import duplicate_index
+    items_by_name = {os.path.basename(item['filename']): item for item in data_list}
+    deduplicated = []
+    for label in sorted(set(item['class'] for item in data_list)):
+        names = [name for name, item in items_by_name.items() if item['class'] == label]
+        deduplicated.extend(items_by_name[group[0]] for group in duplicate_index.group(names))
+    logger.info(f'{len(data_list) - len(deduplicated)} duplicates left out of {len(data_list)} training images')
+    return deduplicated
+
+def train_model_by_session(db_file, session_id, full_train=False, callbacks=None):
     """
     Train the model with the given session id.
+    Optional keras callbacks are passed to model.fit, e.g. to report the progress of a training job.
     """
 
-    # Full train or fine tune
+    # Full train or incremental training
     if full_train:
         data_list = dbf.get_all_labeled_images(db_file, session_id)
     else:
-        data_list = dbf.get_unprocessed_labeled_images(db_file, session_id)
+        new_data_list = dbf.get_unprocessed_labeled_images(db_file, session_id)
+        if not new_data_list:
+            raise ValueError("No new labeled images to train")
+        # Older labels are replayed so the model doesn't forget them
+        new_filenames = set(item['filename'] for item in new_data_list)
+        old_data_list = [item for item in dbf.get_all_labeled_images(db_file, session_id) if item['filename'] not in new_filenames]
+        replay_list = sample_replay_buffer(old_data_list)
+        logger.info(f"Incremental training with {len(new_data_list)} new and {len(replay_list)} replayed images")
+        data_list = new_data_list + replay_list
+    if TRAIN_DEDUPLICATE:
+        data_list = deduplicate_data_list(data_list)
 
     if (len(data_list) < batch_size+1):
         logger.error(f"Too few images to train: {len(data_list)}")
         raise ValueError("Too few labeled images to train")
 
     
-    class_names, number_of_classes, map_label_to_index, map_index_to_label, map_label_to_categorical = extract_labels_and_mappings(data_list)
+    _, saved_label_map = get_current_model(session_id)
+    if saved_label_map:
+        # The existing model outputs the labels in the order of the saved map
+        class_names, number_of_classes, map_label_to_index, map_index_to_label, map_label_to_categorical = extend_label_mappings(
+            saved_label_map, data_list)
+    else:
+        class_names, number_of_classes, map_label_to_index, map_index_to_label, map_label_to_categorical = extract_labels_and_mappings(data_list)
 
     dbf.save_label_map(db_file, session_id, map_index_to_label)
     
     for item in data_list:
         item["label"] = map_label_to_categorical[item["class"]]
 
-    dataset = create_dataset(data_list)
-
-    ## Batch the dataset
-    dataset = dataset.batch(batch_size)
-
-    data_iterator = dataset.as_numpy_iterator()
-    # Scale data
-    dataset = dataset.map(lambda x, y: (x / 255.0, y))
-    scaled_iterator = dataset.as_numpy_iterator()
-
-    # Split data
-    # test_size = int(0.1 * len(dataset)) or 1
-    # val_size = int(0.2 * len(dataset)) or 1
-    val_size = int(0.2 * len(dataset)) or 1
-    # train_size = len(dataset) - test_size - val_size
-    train_size = len(dataset) - val_size
-    logger.info(f"train_size: {train_size} val_size: {val_size}")
-
-    train = dataset.take(train_size)
-    val = dataset.skip(train_size).take(val_size)
-    # test = dataset.skip(train_size + val_size).take(test_size)
-
-    steps_per_epoch = len(train)//train_size
-    validation_steps = len(val)//val_size
-
-    logger.info(f"steps_per_epoch: {steps_per_epoch}")
-    logger.info(f"validation_steps: {validation_steps}")
+    # Split per sample before batching, so both sets have the same distribution
+    train_list, val_list = split_data_list(data_list)
+    logger.info(f"train_size: {len(train_list)} val_size: {len(val_list)}")
+
+    samples_hash = hashlib.sha1(json.dumps([(item['filename'], item['class']) for item in data_list]).encode('utf-8')).hexdigest()[:12]
+    train_cache = TRAIN_DATASET_CACHE
+    val_cache = TRAIN_DATASET_CACHE
+    if TRAIN_DATASET_CACHE == 'memory' and len(data_list) > TRAIN_MEMORY_CACHE_MAX_IMAGES:
+        # 192 KB per image, the images are read from the tensor cache each epoch instead
+        logger.info(f"{len(data_list)} images is over TRAIN_MEMORY_CACHE_MAX_IMAGES, training without the in-memory dataset cache")
+        train_cache = val_cache = ''
+    elif TRAIN_DATASET_CACHE and TRAIN_DATASET_CACHE != 'memory':
+        # tf.data reuses a complete cache file as is, so the name must change with the samples
+        train_cache = f'{TRAIN_DATASET_CACHE}_{session_id}_{samples_hash}_train'
+        val_cache = f'{TRAIN_DATASET_CACHE}_{session_id}_{samples_hash}_val'
+        # The cache files of previous sample sets of the session are never read again
+        for stale_path in glob.glob(f'{TRAIN_DATASET_CACHE}_{session_id}_*'):
+            if not stale_path.startswith(f'{TRAIN_DATASET_CACHE}_{session_id}_{samples_hash}_'):
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
+    train = create_dataset(train_list, shuffle=True, cache=train_cache)
+    val = create_dataset(val_list, cache=val_cache)
+
+    # A checkpoint is only resumed by a training of the same images and labels
+    checkpoint_folder = get_checkpoint_folder(session_id)
+    signature = f'{samples_hash}_{number_of_classes}_{int(full_train)}'
+    checkpoint = load_checkpoint(checkpoint_folder, signature)
+    if checkpoint:
+        model, initial_epoch, resume_state = checkpoint
+    else:
+        model = get_or_create_model(session_id, number_of_classes)
+        model = expand_output_layer(model, number_of_classes)
+        initial_epoch, resume_state = 0, None
 
-    model = get_or_create_model(session_id, number_of_classes)
+    # The epoch time and the early stopping go first, so the callbacks of the caller see their logs
+    early_stopping = BestWeightsEarlyStopping(resume_state=resume_state)
+    callbacks = [InputPipelineMonitor(), EpochTimer(), early_stopping,
+                 TrainingCheckpoint(checkpoint_folder, signature, early_stopping)] + (callbacks or [])
 
-    if full_train:
-        model, history = fine_tune_model(model, train, val)
-    else:
-        model, history = fine_tune_model(model, train, val, epochs=5)
+    epochs = TRAIN_MAX_EPOCHS if full_train else INCREMENTAL_EPOCHS
+    model, history = fine_tune_model(model, train, val, epochs=epochs, callbacks=callbacks, initial_epoch=initial_epoch)
+    last_epoch = history.epoch[-1] + 1 if history.epoch else initial_epoch
+    logger.info(f"Training stopped after epoch {last_epoch}, best epoch: {early_stopping.best_epoch + 1}")
 
-    save_model(model, session_id)
+    save_model(model, session_id, map_index_to_label, {'full_train': full_train, 'images': len(data_list),
+                                                       'epochs': last_epoch, 'best_epoch': early_stopping.best_epoch + 1})
+    clear_checkpoint(checkpoint_folder)
 
     # Finally set images in the session as processed
-    dbf.set_images_processed(db_file, session_id)    
+    dbf.set_images_processed(db_file, session_id)
+    return history
 
 
 def predict_image(image_path, session_id):
     """
     Predict the image with the given session id.
     """
-    model = tf.keras.models.load_model(CLS_MODEL_FOLDER + f'/model_{session_id}.h5')
-    image = tf.io.read_file(image_path)
-    image = tf.image.decode_image(image, channels=3, expand_animations = False)
-    image = tf.image.resize(image, [256, 256])
+    predictor, map_index_to_label, _ = get_session_predictor(session_id)
+    image = load_cached_image(tf.constant(image_path))
     image = tf.expand_dims(image, axis=0)
     image = image / 255.0
-    prediction = model.predict(image)
-
-    #get labels and mappings
-    map_index_to_label = dbf.get_label_map(db_file, session_id) # try to get the label map from the database
-    if not map_index_to_label:
-        data_list = dbf.get_all_labeled_images(db_file, session_id)
-        class_names, number_of_classes, map_label_to_index, map_index_to_label, map_label_to_categorical = extract_labels_and_mappings(data_list)
-
+    with span('predict'):
+        prediction = predictor(image)
+    inc(predictions_total)
 
     return map_index_to_label[np.argmax(prediction)]
 
-def predict_images(session_id, image_amount) -> bool:
+# Version of each session model this process predicts with, and the versions being loaded to replace them
+_served_versions = {}
+_loading_versions = set()
+_served_versions_lock = threading.Lock()
+
+def get_served_version(session_id: int):
     """
-    Predict the images with the given session id.
-    Return True if there are images to predict, False otherwise.
+    Get the registry version to predict with. When a new version is published, the previous one keeps serving
+    while the new one loads in the background, and the next call after it's loaded switches to it.
     """
+    current = model_registry.current_version(session_id)
+    if current is None:
+        return None
+    with _served_versions_lock:
+        served = _served_versions.get(session_id)
+        if served is None or served == current or not os.path.exists(model_registry.model_path(session_id, served)):
+            _served_versions[session_id] = current
+            return current
+        if (session_id, current) not in _loading_versions:
+            _loading_versions.add((session_id, current))
+            threading.Thread(target=_load_version, args=(session_id, current), name=f'model-load-{session_id}', daemon=True).start()
+        return served
+
+def _load_version(session_id: int, version: int):
+    try:
+        get_predictor(model_registry.model_path(session_id, version)) # Loads it in the caches
+    except Exception as _:
+        # Stays in _loading_versions so it's not retried on every prediction, the previous version keeps serving
+        logger.error(f'Could not load model version {version} of session {session_id}', exc_info=True)
+        return
+    with _served_versions_lock:
+        previous = _served_versions.get(session_id)
+        _served_versions[session_id] = version
+        _loading_versions.discard((session_id, version))
+    logger.info(f'Session {session_id} switched from model version {previous} to {version}')
+
+def get_prediction_version(session_id: int) -> int:
+    """
+    Get the model version the predictions of the session are made with, 0 for a model saved before the registry
+    or the base model.
+    """
+    return get_served_version(session_id) or 0
 
-    image_list = dbf.obtain_unlabeled_images_from_session(db_file, session_id)
-    if not image_list:
-        return False
-
+def get_session_predictor(session_id: int):
+    """
+    Get the predictor of the session model (or the base model if the session has none), its label map and version.
+    Return None, None, None if there is no model.
+    """
+    version = get_served_version(session_id)
+    if version is not None:
+        return get_predictor(model_registry.model_path(session_id, version)), model_registry.get_label_map(session_id, version), version
 
     map_index_to_label = dbf.get_label_map(db_file, session_id) # try to get the label map from the database
     if not map_index_to_label:
@@ -203,24 +493,95 @@ def predict_images(session_id, image_amount) -> bool:
         model_filepath = CLS_MODEL_FOLDER + f'/model_base.h5'
         if not os.path.exists(model_filepath):
             logger.error(f"Model file not found: {model_filepath}")
-            return None
-
-    model = tf.keras.models.load_model(model_filepath)
-    for image_name in image_list[:image_amount]:
-        image_path = INPUT_IMAGE_FOLDER + '/' + image_name
-        image = tf.io.read_file(image_path)
-        try:
-            image = tf.image.decode_image(image, channels=3, expand_animations = False)
-            image = tf.image.resize(image, [256, 256])
-            image = tf.expand_dims(image, axis=0)
-            image = image / 255.0
-            prediction = model.predict(image)
-            dbf.add_prediction(db_file, image_name, map_index_to_label[np.argmax(prediction)], session_id)
-        except InvalidArgumentError as e:
-            import traceback
-            tb = traceback.format_exc()
-            dbf.new_exc_error(db_file, session_id, tb, image_path)
-            logger.error(f"{tb}")
-            logger.error(f"Error predicting image: {image_path}")
-    
-    return True
\ No newline at end of file
+            return None, None, None
+    return get_predictor(model_filepath), map_index_to_label, 0
+
+def predict_images(session_id, image_amount) -> bool:
+    """
+    Predict the images with the given session id.
+    Return True if there are images to predict, False otherwise.
+    Only the images without a prediction of the served model version are predicted, images that could
+    not be decoded are quarantined and not picked again.
+    """
+
+    image_list = dbf.obtain_unpredicted_images_from_session(db_file, session_id, get_prediction_version(session_id))
+    if not image_list:
+        return False
+
+    predictor, map_index_to_label, model_version = get_session_predictor(session_id)
+    if predictor is None:
+        return None
+
+    image_names = image_list[:image_amount]
+    groups = []
+    if DEDUP_ENABLED:
+        from dedup.duplicates import duplicate_index
+        # Only the first image of each group of duplicates is predicted, the others get its prediction
+        groups = duplicate_index.group(image_list, max_groups=image_amount)
+        image_names = [group[0] for group in groups]
+    predictions = []
+    predicted_names = set()
+    for names, images in create_prediction_dataset(image_names):
+        with span('predict'):
+            probabilities = predictor(images)
+        inc(predictions_total, len(probabilities))
+        label_indexes = np.argmax(probabilities, axis=1)
+        for name, label_index in zip(names.numpy(), label_indexes):
+            name = name.decode('utf-8')
+            predicted_names.add(name)
+            predictions.append((name, map_index_to_label[int(label_index)]))
+
+    predicted_labels = dict(predictions)
+    for group in groups:
+        if group[0] in predicted_labels:
+            predictions.extend((name, predicted_labels[group[0]]) for name in group[1:])
+    dbf.add_predictions(db_file, predictions, session_id, model_version)
+
+    # Images dropped by the pipeline could not be read or decoded
+    for image_name in image_names:
+        if image_name not in predicted_names:
+            quarantine_image(session_id, INPUT_IMAGE_FOLDER + '/' + image_name)
+
+    # A batch where every image was quarantined leaves nothing to predict if it was the last one
+    picked = sum(len(group) for group in groups) if groups else len(image_names)
+    return bool(predictions) or picked < len(image_list)
+
+def quarantine_image(session_id, image_path):
+    """
+    Store the error of an image that could not be decoded, so it's not picked again.
+    An image that decodes when tried alone is left to be predicted by the next refill.
+    """
+    import traceback
+    try:
+        decode_and_resize(image_path)
+        logger.warning(f"Image dropped from prediction batch but decodes, it will be retried: {image_path}")
+        return
+    except (InvalidArgumentError, tf.errors.OpError):
+        tb = traceback.format_exc()
+    inc(decode_failures_total)
+    dbf.new_exc_error(db_file, session_id, tb, image_path)
+    logger.error(f"{tb}")
+    logger.error(f"Error predicting image: {image_path}")
+
+def get_model_cache_stats() -> dict:
+    """
+    Get the hit/miss counters of the in-memory model cache.
+    """
+    return model_cache.stats()
+
+def get_serving_status(session_id: int) -> dict:
+    """
+    Get the export report of the session model and the format used to predict.
+    """
+    model_filepath, _ = get_current_model(session_id)
+    report = get_serving_report(model_filepath) if model_filepath else None
+    return {'report': report, 'format': select_serving_format(report)}
+
+def get_model_versions(session_id: int) -> dict:
+    """
+    Get the versions of the session model in the registry and the one this process predicts with.
+    """
+    status = model_registry.status(session_id)
+    with _served_versions_lock:
+        status['served'] = _served_versions.get(session_id)
+    return status
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import tensorflow as tf
+from settings.config import log_config, BACKBONE_WEIGHTS_FILE, EMBEDDING_CACHE_FOLDER, HEAD_EPOCHS, TRAIN_DEDUPLICATE
+import db.db_funcs as dbf
+import classifier.classifier as clf
+from classifier.checkpoints import EpochTimer, BestWeightsEarlyStopping
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+
+def get_feature_extractor(session_id: int) -> tf.keras.Model:
+    """
+    Get the frozen feature extractor: the BACKBONE_WEIGHTS_FILE model if set, otherwise the session model
+    without its output layer. Raises ValueError if there is none.
+    """
+    if BACKBONE_WEIGHTS_FILE:
+        backbone = tf.keras.models.load_model(BACKBONE_WEIGHTS_FILE, compile=False)
+        outputs = backbone.output
+        if len(outputs.shape) == 4:
+            # Feature maps are pooled to a vector
+            outputs = tf.keras.layers.GlobalAveragePooling2D()(outputs)
+        extractor = tf.keras.Model(backbone.input, outputs)
+    else:
+        model_file, _ = clf.get_current_model(session_id)
+        if model_file is None:
+            raise ValueError("No model to extract features from, train the full model first")
+        model = tf.keras.models.load_model(model_file, compile=False)
+        extractor = tf.keras.Model(model.inputs, model.layers[-2].output)
+    extractor.trainable = False
+    return extractor
+
+def get_backbone_id(extractor: tf.keras.Model) -> str:
+    """
+    Identify the feature extractor by its weights, the embeddings are only valid for the same weights.
+    """
+    weights_hash = hashlib.sha1()
+    for weights in extractor.get_weights():
+        weights_hash.update(np.ascontiguousarray(weights).tobytes())
+    return weights_hash.hexdigest()[:16]
+
+
+class EmbeddingStore:
+    """
+    Append only float16 array of image embeddings on disk, one folder per feature extractor.
+    Rows are found by image path plus its mtime and size, so modified images get a new embedding.
+    A store of a session trunk (session_id given) replaces the stores of the previous trunks of the session,
+    their embeddings are never valid again after a retrain.
+    """
+
+    def __init__(self, backbone_id: str, dim: int, cache_folder: str = EMBEDDING_CACHE_FOLDER, session_id: int = None):
+        self.folder = os.path.join(cache_folder, backbone_id)
+        self.dim = dim
+        self.data_path = os.path.join(self.folder, 'embeddings.f16')
+        self.index_path = os.path.join(self.folder, 'index.json')
+        os.makedirs(self.folder, exist_ok=True)
+        if session_id is not None:
+            self._replace_session_stores(cache_folder, backbone_id, session_id)
+
+    def _replace_session_stores(self, cache_folder: str, backbone_id: str, session_id: int):
+        with open(os.path.join(self.folder, 'session.txt'), 'w') as f:
+            f.write(str(session_id))
+        for name in os.listdir(cache_folder):
+            if name == backbone_id:
+                continue
+            try:
+                with open(os.path.join(cache_folder, name, 'session.txt')) as f:
+                    owner = f.read().strip()
+            except (FileNotFoundError, NotADirectoryError):
+                continue # Shared BACKBONE_WEIGHTS_FILE store
+            if owner == str(session_id):
+                shutil.rmtree(os.path.join(cache_folder, name), ignore_errors=True)
+                logger.info(f'Embeddings of a previous model of session {session_id} removed: {name}')
+
+    @staticmethod
+    def image_key(image_path: str) -> str:
+        stat = os.stat(image_path)
+        return f'{os.path.abspath(image_path)}:{stat.st_mtime_ns}:{stat.st_size}'
+
+    @contextmanager
+    def _locked(self):
+        # Training jobs of several sessions can share an extractor
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(os.path.join(self.folder, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_index(self) -> dict[str, int]:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _stored_rows(self) -> int:
+        # Rows are counted from the data file, it can hold rows that never made it to the index after a crash
+        try:
+            return os.path.getsize(self.data_path) // (self.dim * 2)
+        except FileNotFoundError:
+            return 0
+
+    def get(self, keys: list[str]) -> tuple[np.ndarray, list[int]]:
+        """
+        Get the embeddings of the given keys (zeros for the missing ones) and the position of the missing keys.
+        """
+        index = self._load_index()
+        embeddings = np.zeros((len(keys), self.dim), dtype=np.float16)
+        missing = [i for i, key in enumerate(keys) if key not in index]
+        if len(index):
+            stored = np.memmap(self.data_path, dtype=np.float16, mode='r', shape=(self._stored_rows(), self.dim))
+            for i, key in enumerate(keys):
+                row = index.get(key)
+                if row is not None:
+                    embeddings[i] = stored[row]
+        return embeddings, missing
+
+    def add(self, keys: list[str], embeddings: np.ndarray):
+        """
+        Append new embeddings to the store.
+        """
+        with self._locked():
+            index = self._load_index()
+            new_rows = [(key, row) for key, row in zip(keys, embeddings) if key not in index]
+            if not new_rows:
+                return
+            next_row = self._stored_rows()
+            with open(self.data_path, 'ab') as f:
+                # Drop a row partially written before a crash, so the new rows start at their offset
+                f.truncate(next_row * self.dim * 2)
+                for key, row in new_rows:
+                    index[key] = next_row
+                    next_row += 1
+                    f.write(np.asarray(row, dtype=np.float16).tobytes())
+            tmp_path = self.index_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, self.index_path)
+
+
+def compute_embeddings(extractor: tf.keras.Model, image_paths: list[str]) -> np.ndarray:
+    """
+    Run the feature extractor over the images, reading them through the tensor cache.
+    """
+    dataset = tf.data.Dataset.from_tensor_slices(image_paths)
+    dataset = dataset.map(lambda filename: clf.load_cached_image(filename) / 255.0, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.batch(clf.predict_batch_size).prefetch(tf.data.AUTOTUNE)
+    return np.concatenate([extractor(images, training=False).numpy() for images in dataset]).astype(np.float16)
+
+def get_embeddings(extractor: tf.keras.Model, store: EmbeddingStore, image_paths: list[str]) -> np.ndarray:
+    """
+    Get the embeddings of the images, computing only the ones not in the store yet.
+    """
+    keys = [EmbeddingStore.image_key(image_path) for image_path in image_paths]
+    embeddings, missing = store.get(keys)
+    if missing:
+        start = time.time()
+        new_embeddings = compute_embeddings(extractor, [image_paths[i] for i in missing])
+        store.add([keys[i] for i in missing], new_embeddings)
+        embeddings[missing] = new_embeddings
+        logger.info(f'{len(missing)} embeddings computed in {time.time() - start:.1f}s, {len(keys) - len(missing)} read from the store')
+    return embeddings
+
+def train_head_by_session(db_file, session_id, callbacks=None):
+    """
+    Train only a classification head on the embeddings of the frozen feature extractor, using every labeled image
+    of the session. The extractor and the head are saved together as the session model.
+    """
+    data_list = dbf.get_all_labeled_images(db_file, session_id)
+    if TRAIN_DEDUPLICATE:
+        data_list = clf.deduplicate_data_list(data_list)
+    if (len(data_list) < clf.batch_size+1):
+        logger.error(f"Too few images to train: {len(data_list)}")
+        raise ValueError("Too few labeled images to train")
+
+    class_names, number_of_classes, map_label_to_index, map_index_to_label, map_label_to_categorical = clf.extract_labels_and_mappings(data_list)
+
+    extractor = get_feature_extractor(session_id)
+    store = EmbeddingStore(get_backbone_id(extractor), extractor.output.shape[-1],
+                           session_id=None if BACKBONE_WEIGHTS_FILE else session_id)
+
+    train_list, val_list = clf.split_data_list(data_list)
+    train_x = get_embeddings(extractor, store, [item['filename'] for item in train_list]).astype(np.float32)
+    val_x = get_embeddings(extractor, store, [item['filename'] for item in val_list]).astype(np.float32)
+    train_y = np.array([map_label_to_categorical[item['class']] for item in train_list])
+    val_y = np.array([map_label_to_categorical[item['class']] for item in val_list])
+
+    head = tf.keras.layers.Dense(number_of_classes, activation='softmax')
+    head_model = tf.keras.Sequential([tf.keras.layers.InputLayer(input_shape=(train_x.shape[1],)), head])
+    head_model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
+    history = head_model.fit(train_x, train_y, batch_size=clf.batch_size, epochs=HEAD_EPOCHS, validation_data=(val_x, val_y),
+                             verbose=1, callbacks=[EpochTimer(), BestWeightsEarlyStopping()] + (callbacks or []))
+
+    # The saved model takes images like the others, so the predict paths don't change.
+    # The layers are unfrozen first, otherwise the saved model keeps them frozen for the next full or incremental training
+    extractor.trainable = True
+    model = tf.keras.Model(extractor.input, head(extractor.output))
+    model.compile(loss='categorical_crossentropy', optimizer='rmsprop', metrics=['accuracy'])
+    dbf.save_label_map(db_file, session_id, map_index_to_label)
+    clf.save_model(model, session_id, map_index_to_label, {'head_only': True, 'images': len(data_list)})
+
+    # Finally set images in the session as processed
+    dbf.set_images_processed(db_file, session_id)
+    return history
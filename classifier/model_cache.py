@@ -0,0 +1,110 @@
+import os
+import threading
+from collections import OrderedDict
+
+from settings.config import log_config, MODEL_CACHE_SIZE
+from monitoring.metrics import span
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+
+def load_keras_model(model_filepath: str):
+    # Tensorflow is only imported when the first model is loaded
+    import tensorflow as tf
+    return tf.keras.models.load_model(model_filepath)
+
+
+class ModelCache:
+    """
+    In-process LRU cache of keras models keyed by model file path.
+    An entry is reloaded when the file on disk changes (mtime or size).
+    A different loader can be given to cache other kinds of models stored in a file.
+    """
+
+    def __init__(self, max_size: int = MODEL_CACHE_SIZE, loader=None):
+        self.max_size = max(1, max_size)
+        self.loader = loader or load_keras_model
+        self._models = OrderedDict() # model_filepath -> (file signature, model)
+        self._loading = {} # model_filepath -> event set when its load finishes
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _file_signature(model_filepath: str) -> tuple[int, int]:
+        stat = os.stat(model_filepath)
+        return stat.st_mtime_ns, stat.st_size
+
+    def get(self, model_filepath: str):
+        """
+        Get the model stored in model_filepath, loading it from disk only if it's not cached or it changed.
+        """
+        signature = self._file_signature(model_filepath)
+        while True:
+            with self._lock:
+                entry = self._models.get(model_filepath)
+                if entry is not None and entry[0] == signature:
+                    self._models.move_to_end(model_filepath)
+                    self.hits += 1
+                    return entry[1]
+                loading = self._loading.get(model_filepath)
+                if loading is None:
+                    loading = self._loading[model_filepath] = threading.Event()
+                    if entry is not None:
+                        self.reloads += 1
+                        logger.info(f'Model file changed, reloading: {model_filepath}')
+                    self.misses += 1
+                    break
+            # Another thread is loading the same file, use its model once loaded (or load it if that failed)
+            loading.wait()
+
+        # Loaded without the lock, so the cached models keep serving meanwhile
+        model = None
+        try:
+            with span('model_load'):
+                model = self.loader(model_filepath)
+        finally:
+            with self._lock:
+                if model is not None:
+                    self._models[model_filepath] = (signature, model)
+                    self._models.move_to_end(model_filepath)
+                    while len(self._models) > self.max_size:
+                        evicted_filepath, _ = self._models.popitem(last=False)
+                        self.evictions += 1
+                        logger.info(f'Model evicted from cache: {evicted_filepath}')
+                del self._loading[model_filepath]
+                loading.set()
+        return model
+
+    def invalidate(self, model_filepath: str = None):
+        """
+        Remove a model from the cache, or every model if no path is given.
+        """
+        with self._lock:
+            if model_filepath is None:
+                self._models.clear()
+            else:
+                self._models.pop(model_filepath, None)
+
+    def stats(self) -> dict:
+        """
+        Get the hit/miss counters and the models currently in memory.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'evictions': self.evictions,
+                'size': len(self._models),
+                'max_size': self.max_size,
+                'models': list(self._models.keys()),
+            }
+
+
+model_cache = ModelCache()
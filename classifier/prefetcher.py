@@ -0,0 +1,139 @@
+import threading
+import time
+
+from settings.config import (log_config, PREFETCH_WATERMARK, PREFETCH_REFILL_AMOUNT, PREFETCH_POLL_SECONDS,
+                             PREFETCH_SESSION_TTL_SECONDS)
+import db.db_funcs as dbf
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+
+class PredictionPrefetcher:
+    """
+    Background worker that keeps a watermark of unlabeled predictions for every active session,
+    so the labeling requests don't have to wait for the model.
+    """
+
+    def __init__(self, db_filepath: str, watermark: int = PREFETCH_WATERMARK, refill_amount: int = PREFETCH_REFILL_AMOUNT,
+                 poll_seconds: float = PREFETCH_POLL_SECONDS, session_ttl_seconds: float = PREFETCH_SESSION_TTL_SECONDS):
+        self.db_filepath = db_filepath
+        self.watermark = watermark
+        self.refill_amount = refill_amount
+        self.poll_seconds = poll_seconds
+        self.session_ttl_seconds = session_ttl_seconds
+
+        self._sessions = {} # session_id -> dict with last_seen, queue_depth, exhausted_until, refills...
+        self._session_locks = {} # session_id -> lock, so a session is never predicted twice at the same time
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Start the worker thread if it's not running.
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='prediction-prefetcher', daemon=True)
+            self._thread.start()
+            logger.info('Prediction prefetcher started')
+
+    def stop(self, timeout: float = 10):
+        """
+        Ask the worker to stop and wait until the current refill is done.
+        """
+        self._stop.set()
+        self._wake.set()
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+        logger.info('Prediction prefetcher stopped')
+
+    def touch(self, session_id):
+        """
+        Mark a session as active and wake the worker to check its queue.
+        """
+        session_id = int(session_id)
+        with self._lock:
+            state = self._sessions.setdefault(session_id, self._new_session_state())
+            state['last_seen'] = time.time()
+        self.start()
+        self._wake.set()
+
+    def refill(self, session_id, image_amount: int = None) -> bool:
+        """
+        Predict a new batch of images for the session right away.
+        Return True if there were images to predict, False otherwise.
+        """
+        session_id = int(session_id)
+        image_amount = image_amount or self.refill_amount
+        import classifier.classifier as clf # Loads tensorflow on the first refill
+        with self._get_session_lock(session_id):
+            start = time.time()
+            can_predict_images = clf.predict_images(session_id=session_id, image_amount=image_amount)
+            elapsed = time.time() - start
+
+        with self._lock:
+            state = self._sessions.setdefault(session_id, self._new_session_state())
+            state['refills'] += 1
+            state['last_refill_seconds'] = round(elapsed, 3)
+            if not can_predict_images:
+                # Nothing to predict (or no model yet), don't retry on every poll
+                state['exhausted_until'] = time.time() + self.session_ttl_seconds / 10
+        return can_predict_images
+
+    def status(self) -> dict:
+        """
+        Get the worker state and the prediction queue depth of each active session.
+        """
+        with self._lock:
+            sessions = {session_id: dict(state) for session_id, state in self._sessions.items()}
+        return {
+            'running': self._thread is not None and self._thread.is_alive(),
+            'watermark': self.watermark,
+            'refill_amount': self.refill_amount,
+            'sessions': sessions,
+        }
+
+    @staticmethod
+    def _new_session_state() -> dict:
+        return {'last_seen': time.time(), 'queue_depth': None, 'exhausted_until': 0, 'refills': 0, 'last_refill_seconds': None}
+
+    def _get_session_lock(self, session_id: int) -> threading.Lock:
+        with self._lock:
+            return self._session_locks.setdefault(session_id, threading.Lock())
+
+    def _active_sessions(self) -> list[int]:
+        now = time.time()
+        with self._lock:
+            for session_id in [s for s, state in self._sessions.items() if now - state['last_seen'] > self.session_ttl_seconds]:
+                del self._sessions[session_id]
+            return [s for s, state in self._sessions.items() if state['exhausted_until'] <= now]
+
+    def _run(self):
+        while not self._stop.is_set():
+            for session_id in self._active_sessions():
+                if self._stop.is_set():
+                    break
+                try:
+                    # Predictions of another model version don't count, so they are refreshed once a new version is served.
+                    # Same version as predict_images, the previous one while a new one loads
+                    import classifier.classifier as clf # Loads tensorflow, like the first refill
+                    model_version = clf.get_prediction_version(session_id)
+                    queue_depth = dbf.count_unprocessed_predictions(self.db_filepath, session_id, model_version)
+                    with self._lock:
+                        if session_id in self._sessions:
+                            self._sessions[session_id]['queue_depth'] = queue_depth
+                    if queue_depth < self.watermark:
+                        logger.info(f'Prefetching predictions for session {session_id}, queue depth: {queue_depth}')
+                        self.refill(session_id)
+                except Exception as _:
+                    logger.error(f'Error prefetching predictions for session {session_id}', exc_info=True)
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
@@ -0,0 +1,182 @@
+import json
+import os
+import re
+import shutil
+import time
+from contextlib import contextmanager
+
+from settings.config import log_config, MODEL_REGISTRY_FOLDER, MODEL_REGISTRY_KEEP
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+MODEL_FILENAME = 'model.h5'
+_VERSION_FOLDER = re.compile(r'^v(\d+)$')
+
+
+class ModelRegistry:
+    """
+    Versioned models of each session, stored in <root>/session_<id>/v<version>/ with their label map.
+    A version is written in a temporary folder and published with a rename, so a version folder is complete and
+    never changes. state.json tells which version is served; a pinned version stays served when new ones are published.
+    """
+
+    def __init__(self, root: str = MODEL_REGISTRY_FOLDER, keep: int = MODEL_REGISTRY_KEEP):
+        self.root = root
+        self.keep = max(2, keep)
+        self._states = {} # session_id -> (state file signature, state)
+
+    def _session_folder(self, session_id: int) -> str:
+        return os.path.join(self.root, f'session_{session_id}')
+
+    def version_folder(self, session_id: int, version: int) -> str:
+        return os.path.join(self._session_folder(session_id), f'v{version:04d}')
+
+    def model_path(self, session_id: int, version: int) -> str:
+        return os.path.join(self.version_folder(session_id, version), MODEL_FILENAME)
+
+    @contextmanager
+    def _locked(self, session_id: int):
+        # The server and the training processes publish and pin versions
+        folder = self._session_folder(session_id)
+        os.makedirs(folder, exist_ok=True)
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(os.path.join(folder, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def list_versions(self, session_id: int) -> list[int]:
+        try:
+            names = os.listdir(self._session_folder(session_id))
+        except FileNotFoundError:
+            return []
+        return sorted(int(match.group(1)) for match in map(_VERSION_FOLDER.match, names) if match)
+
+    def _read_state(self, session_id: int) -> dict:
+        state_path = os.path.join(self._session_folder(session_id), 'state.json')
+        try:
+            stat = os.stat(state_path)
+        except FileNotFoundError:
+            return {'current': None, 'pinned': False}
+        # Read on every prediction, only parsed when it changed
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = self._states.get(session_id)
+        if cached is not None and cached[0] == signature:
+            return dict(cached[1])
+        with open(state_path) as f:
+            state = json.load(f)
+        self._states[session_id] = (signature, state)
+        return dict(state)
+
+    def _write_state(self, session_id: int, state: dict):
+        state_path = os.path.join(self._session_folder(session_id), 'state.json')
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+
+    def current_version(self, session_id: int):
+        """
+        Get the version served for the session, None if it has no published model.
+        """
+        return self._read_state(session_id)['current']
+
+    def get_label_map(self, session_id: int, version: int) -> dict[int, str]:
+        with open(os.path.join(self.version_folder(session_id, version), 'label_map.json')) as f:
+            return {int(index): label for index, label in json.load(f).items()}
+
+    def get_metadata(self, session_id: int, version: int) -> dict:
+        with open(os.path.join(self.version_folder(session_id, version), 'metadata.json')) as f:
+            return json.load(f)
+
+    def publish(self, session_id: int, write_artifacts, label_map: dict[int, str], metadata: dict = None) -> int:
+        """
+        Publish a new version. write_artifacts(folder) writes the model as MODEL_FILENAME, and optionally other
+        artifacts, in a temporary folder that becomes the version folder once complete.
+        The new version is served unless a version is pinned. Return the new version.
+        """
+        with self._locked(session_id):
+            version = max(self.list_versions(session_id), default=0) + 1
+            tmp_folder = os.path.join(self._session_folder(session_id), f'.v{version:04d}.tmp')
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            os.makedirs(tmp_folder)
+            start = time.time()
+            try:
+                write_artifacts(tmp_folder)
+                with open(os.path.join(tmp_folder, 'label_map.json'), 'w') as f:
+                    json.dump({str(index): label for index, label in label_map.items()}, f)
+                with open(os.path.join(tmp_folder, 'metadata.json'), 'w') as f:
+                    json.dump(dict(metadata or {}, version=version, created=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())), f)
+                os.rename(tmp_folder, self.version_folder(session_id, version))
+            except BaseException:
+                shutil.rmtree(tmp_folder, ignore_errors=True)
+                raise
+
+            state = self._read_state(session_id)
+            if not state['pinned']:
+                state['current'] = version
+                self._write_state(session_id, state)
+            logger.info(f'Model version {version} of session {session_id} published in {time.time() - start:.1f}s, '
+                        f'serving version {state["current"]}{" (pinned)" if state["pinned"] else ""}')
+            self._prune(session_id, state)
+        return version
+
+    def _prune(self, session_id: int, state: dict):
+        versions = self.list_versions(session_id)
+        for version in versions[:-self.keep]:
+            if version != state['current']:
+                shutil.rmtree(self.version_folder(session_id, version), ignore_errors=True)
+                logger.info(f'Model version {version} of session {session_id} removed')
+
+    def pin(self, session_id: int, version: int):
+        """
+        Serve the given version until unpinned, also after newer versions are published.
+        """
+        with self._locked(session_id):
+            if version not in self.list_versions(session_id):
+                raise ValueError(f'Session {session_id} has no model version {version}')
+            self._write_state(session_id, {'current': version, 'pinned': True})
+        logger.info(f'Model version {version} of session {session_id} pinned')
+
+    def unpin(self, session_id: int):
+        """
+        Serve the latest version again, and the next published ones.
+        """
+        with self._locked(session_id):
+            versions = self.list_versions(session_id)
+            self._write_state(session_id, {'current': versions[-1] if versions else None, 'pinned': False})
+
+    def rollback(self, session_id: int) -> int:
+        """
+        Pin the version published before the served one. Return it.
+        """
+        current = self.current_version(session_id)
+        older = [version for version in self.list_versions(session_id) if current is None or version < current]
+        if not older:
+            raise ValueError(f'Session {session_id} has no model version to roll back to')
+        self.pin(session_id, older[-1])
+        return older[-1]
+
+    def status(self, session_id: int) -> dict:
+        """
+        Get the served version and the metadata of every stored version.
+        """
+        state = self._read_state(session_id)
+        versions = []
+        for version in self.list_versions(session_id):
+            try:
+                versions.append(self.get_metadata(session_id, version))
+            except (FileNotFoundError, ValueError):
+                versions.append({'version': version})
+        return {'current': state['current'], 'pinned': state['pinned'], 'versions': versions}
+
+
+model_registry = ModelRegistry()
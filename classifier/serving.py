@@ -0,0 +1,269 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+from settings.config import log_config, db_file, MODEL_CACHE_SIZE, SERVING_EXPORT_FORMATS, SERVING_FORMAT, \
+    SERVING_MIN_AGREEMENT, SERVING_CALIBRATION_IMAGES, TRAIN_SEED
+import db.db_funcs as dbf
+from classifier.model_cache import ModelCache, model_cache
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+SERVING_FORMATS = ['savedmodel', 'tflite_float16', 'tflite_int8']
+IMAGE_SHAPE = (256, 256, 3)
+
+
+class KerasPredictor:
+    """
+    Runs a keras model, the reference the other artifacts are compared to.
+    """
+    serving_format = 'keras'
+
+    def __init__(self, model: tf.keras.Model):
+        self.model = model
+
+    def __call__(self, images) -> np.ndarray:
+        return self.model(images, training=False).numpy()
+
+
+class SavedModelPredictor:
+    """
+    Runs the traced graph of a model with a fixed signature, without the keras call overhead.
+    """
+    serving_format = 'savedmodel'
+
+    def __init__(self, savedmodel_folder: str):
+        self._loaded = tf.saved_model.load(savedmodel_folder)
+        self._serve = self._loaded.signatures['serving_default']
+
+    def __call__(self, images) -> np.ndarray:
+        return self._serve(images=tf.convert_to_tensor(images, dtype=tf.float32))['probabilities'].numpy()
+
+
+class TFLitePredictor:
+    """
+    Runs a TFLite model. The interpreter is not thread safe, calls are serialized.
+    """
+
+    def __init__(self, tflite_filepath: str):
+        self.serving_format = os.path.splitext(os.path.basename(tflite_filepath))[0]
+        self._interpreter = tf.lite.Interpreter(model_path=tflite_filepath, num_threads=os.cpu_count())
+        self._input_index = self._interpreter.get_input_details()[0]['index']
+        self._output_index = self._interpreter.get_output_details()[0]['index']
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def __call__(self, images) -> np.ndarray:
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            if images.shape[0] != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input_index, images.shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = images.shape[0]
+            self._interpreter.set_tensor(self._input_index, images)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output_index).copy()
+
+
+def get_serving_folder(model_filepath: str) -> str:
+    """
+    Get the folder of the serving artifacts of a model file, next to it.
+    """
+    model_name = os.path.splitext(os.path.basename(model_filepath))[0]
+    return os.path.join(os.path.dirname(model_filepath), 'serving', model_name)
+
+def get_artifact_path(serving_folder: str, serving_format: str) -> str:
+    if serving_format == 'savedmodel':
+        # The cache checks the signature of a file, not of the folder
+        return os.path.join(serving_folder, 'savedmodel', 'saved_model.pb')
+    return os.path.join(serving_folder, serving_format + '.tflite')
+
+def load_predictor(artifact_path: str):
+    if artifact_path.endswith('.tflite'):
+        return TFLitePredictor(artifact_path)
+    return SavedModelPredictor(os.path.dirname(artifact_path))
+
+serving_cache = ModelCache(MODEL_CACHE_SIZE, loader=load_predictor)
+
+
+def _file_signature(filepath: str) -> list[int]:
+    stat = os.stat(filepath)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def get_serving_report(model_filepath: str) -> dict:
+    """
+    Get the report of the last export of a model, None if there is none or the model changed since.
+    """
+    report_path = os.path.join(get_serving_folder(model_filepath), 'report.json')
+    try:
+        with open(report_path) as f:
+            report = json.load(f)
+        if report['model_signature'] != _file_signature(model_filepath):
+            return None
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+    return report
+
+def select_serving_format(report: dict, serving_format: str = SERVING_FORMAT) -> str:
+    """
+    Pick the artifact to predict with: the configured one, or with auto the fastest one that agrees with keras.
+    """
+    if report is None or serving_format == 'keras':
+        return 'keras'
+    artifacts = report['artifacts']
+    if serving_format != 'auto':
+        return serving_format if serving_format in artifacts else 'keras'
+    candidates = [(artifact['ms_per_image'], fmt) for fmt, artifact in artifacts.items()
+                  if artifact['agreement'] >= SERVING_MIN_AGREEMENT and artifact['ms_per_image'] < report['keras']['ms_per_image']]
+    return min(candidates)[1] if candidates else 'keras'
+
+def get_predictor(model_filepath: str):
+    """
+    Get a callable taking a batch of images scaled to [0, 1] and returning the class probabilities.
+    Falls back to the keras model when there is no up to date artifact.
+    """
+    report = get_serving_report(model_filepath)
+    serving_format = select_serving_format(report)
+    if serving_format != 'keras':
+        try:
+            return serving_cache.get(get_artifact_path(get_serving_folder(model_filepath), serving_format))
+        except (OSError, ValueError, tf.errors.OpError) as _:
+            logger.warning(f'Could not load the {serving_format} artifact of {model_filepath}, using keras', exc_info=True)
+    return KerasPredictor(model_cache.get(model_filepath))
+
+
+def _export_savedmodel(model: tf.keras.Model, folder: str):
+    @tf.function(input_signature=[tf.TensorSpec((None, *IMAGE_SHAPE), tf.float32, name='images')])
+    def serve(images):
+        return {'probabilities': model(images, training=False)}
+
+    tmp_folder = folder + '.tmp'
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    tf.saved_model.save(model, tmp_folder, signatures={'serving_default': serve})
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp_folder, folder)
+
+def _export_tflite(model: tf.keras.Model, filepath: str, quantization: str, calibration_images: np.ndarray):
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        # Full integer quantization, the input and output stay float so the pipeline doesn't change
+        converter.representative_dataset = lambda: ([calibration_images[i:i+1]] for i in range(len(calibration_images)))
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    tflite_model = converter.convert()
+    with open(filepath + '.tmp', 'wb') as f:
+        f.write(tflite_model)
+    os.replace(filepath + '.tmp', filepath)
+
+def load_evaluation_images(session_id: int, amount: int = SERVING_CALIBRATION_IMAGES) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Load a random sample of labeled images of the session, split in calibration and evaluation images.
+    Return the calibration images, the evaluation images and their labels.
+    """
+    import classifier.classifier as clf
+    data_list = dbf.get_all_labeled_images(db_file, session_id)
+    random.Random(TRAIN_SEED).shuffle(data_list)
+    data_list = data_list[:amount * 2]
+    images = np.stack([clf.load_cached_image(tf.constant(item['filename'])).numpy() / 255.0 for item in data_list]).astype(np.float32)
+    labels = np.array([item['class'] for item in data_list])
+    # Calibration and evaluation use different images, so the agreement is not measured on the calibration set
+    split = max(1, len(data_list) // 2)
+    return images[:split], images[split:], labels[split:]
+
+def measure_predictor(predictor, images: np.ndarray, batch_size: int) -> tuple[np.ndarray, float, float]:
+    """
+    Run the predictor over the images. Return the predicted indexes, the ms per image in batches and for a single image.
+    """
+    predictor(images[:batch_size]) # Warm up, the first call builds the graph or allocates the tensors
+    start = time.perf_counter()
+    probabilities = np.concatenate([predictor(images[i:i+batch_size]) for i in range(0, len(images), batch_size)])
+    batch_ms = (time.perf_counter() - start) * 1000 / len(images)
+
+    predictor(images[:1])
+    start = time.perf_counter()
+    for i in range(min(10, len(images))):
+        predictor(images[i:i+1])
+    single_ms = (time.perf_counter() - start) * 1000 / min(10, len(images))
+    return np.argmax(probabilities, axis=1), batch_ms, single_ms
+
+def export_serving_artifacts(model: tf.keras.Model, session_id: int, formats: list[str] = SERVING_EXPORT_FORMATS,
+                             model_filepath: str = None, map_index_to_label: dict[int, str] = None) -> dict:
+    """
+    Write the serving artifacts of the model saved in model_filepath (the current session model by default) and
+    a report comparing them to the keras model: agreement of the predicted classes, accuracy on labeled images
+    and latency per image.
+    """
+    import classifier.classifier as clf
+    if model_filepath is None:
+        model_filepath, map_index_to_label = clf.get_current_model(session_id)
+    serving_folder = get_serving_folder(model_filepath)
+    os.makedirs(serving_folder, exist_ok=True)
+
+    calibration_images, images, labels = load_evaluation_images(session_id)
+    if not len(images):
+        images, labels = calibration_images, np.array([]) # Too few images to split, only report the latency
+    if map_index_to_label is None:
+        map_index_to_label = dbf.get_label_map(db_file, session_id)
+
+    def evaluate(predictor) -> dict:
+        indexes, batch_ms, single_ms = measure_predictor(predictor, images, clf.predict_batch_size)
+        predicted = np.array([map_index_to_label[int(i)] for i in indexes])
+        return {'ms_per_image': round(batch_ms, 3), 'ms_single_image': round(single_ms, 3),
+                'accuracy': round(float(np.mean(predicted == labels)), 4) if len(labels) else None}, indexes
+
+    keras_report, keras_indexes = evaluate(KerasPredictor(model))
+    report = {'session_id': session_id, 'model_signature': _file_signature(model_filepath), 'images': len(images),
+              'calibration_images': len(calibration_images), 'keras': keras_report, 'artifacts': {}}
+    for serving_format in formats:
+        if serving_format not in SERVING_FORMATS:
+            logger.error(f'Unknown serving format: {serving_format}')
+            continue
+        start = time.time()
+        try:
+            artifact_path = get_artifact_path(serving_folder, serving_format)
+            if serving_format == 'savedmodel':
+                _export_savedmodel(model, os.path.dirname(artifact_path))
+            else:
+                _export_tflite(model, artifact_path, serving_format.split('_')[1], calibration_images)
+            serving_cache.invalidate(artifact_path)
+            artifact_report, indexes = evaluate(load_predictor(artifact_path))
+        except Exception as _:
+            logger.error(f'Could not export the {serving_format} artifact of session {session_id}', exc_info=True)
+            continue
+        artifact_report['agreement'] = round(float(np.mean(indexes == keras_indexes)), 4)
+        artifact_report['size_bytes'] = sum(os.path.getsize(os.path.join(root, name))
+                                            for root, _, names in os.walk(os.path.dirname(artifact_path)) for name in names
+                                            if serving_format == 'savedmodel' or name == os.path.basename(artifact_path))
+        artifact_report['export_seconds'] = round(time.time() - start, 2)
+        report['artifacts'][serving_format] = artifact_report
+
+    report['selected'] = select_serving_format(report)
+    with open(os.path.join(serving_folder, 'report.json.tmp'), 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(os.path.join(serving_folder, 'report.json.tmp'), os.path.join(serving_folder, 'report.json'))
+    logger.info(f'Serving artifacts of session {session_id}: {json.dumps(report)}')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the serving artifacts of a session model and report their accuracy and latency')
+    parser.add_argument('--session', type=int, required=True, help='Session whose model is exported')
+    parser.add_argument('--formats', default=','.join(SERVING_FORMATS), help='Comma separated formats to export')
+    args = parser.parse_args()
+    import classifier.classifier as clf
+    model_filepath, _ = clf.get_current_model(args.session)
+    if model_filepath is None:
+        raise SystemExit(f'Session {args.session} has no model')
+    model = tf.keras.models.load_model(model_filepath)
+    print(json.dumps(export_serving_artifacts(model, args.session, args.formats.split(',')), indent=2))
@@ -0,0 +1,175 @@
+import argparse
+import glob
+import hashlib
+import os
+import threading
+import time
+
+import numpy as np
+from settings.config import log_config, db_file, TENSOR_CACHE_FOLDER, TENSOR_CACHE_MAX_BYTES
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+IMAGE_SHAPE = (256, 256, 3)
+
+
+class TensorCache:
+    """
+    On-disk cache of decoded and resized images stored as uint8 .npy files, opened memory mapped.
+    Entries are keyed by the image path plus its mtime and size, so a modified image is decoded again.
+    """
+
+    def __init__(self, cache_folder: str = TENSOR_CACHE_FOLDER, max_bytes: int = TENSOR_CACHE_MAX_BYTES):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None # Computed lazily from the folder
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_prefix(self, image_path: str) -> str:
+        path_hash = hashlib.sha1(os.path.abspath(image_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_folder, path_hash[:2], path_hash)
+
+    def _entry_path(self, image_path: str) -> str:
+        stat = os.stat(image_path)
+        return f'{self._entry_prefix(image_path)}_{stat.st_mtime_ns}_{stat.st_size}.npy'
+
+    def get(self, image_path: str) -> np.ndarray:
+        """
+        Get the cached image as a read only memory mapped array, or None if it's not cached.
+        """
+        entry_path = self._entry_path(image_path)
+        try:
+            array = np.load(entry_path, mmap_mode='r')
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(entry_path) # Keeps the least recently used order for the eviction
+        self.hits += 1
+        return array
+
+    def put(self, image_path: str, array: np.ndarray):
+        """
+        Store the decoded image, replacing any stale entry of the same file.
+        """
+        entry_path = self._entry_path(image_path)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        self.invalidate(image_path)
+
+        # Write to a temp file first so readers in other processes never see half written entries
+        tmp_path = f'{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(array, dtype=np.uint8))
+        os.replace(tmp_path, entry_path)
+
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += os.path.getsize(entry_path)
+        self._evict_if_needed()
+
+    def get_or_create(self, image_path: str, decode_fn) -> np.ndarray:
+        """
+        Get the cached image or decode it with decode_fn(image_path) -> uint8 array and cache it.
+        """
+        array = self.get(image_path)
+        if array is not None:
+            return array
+        array = decode_fn(image_path)
+        self.put(image_path, array)
+        return array
+
+    def invalidate(self, image_path: str):
+        """
+        Remove every cached entry of an image.
+        """
+        for stale_path in glob.glob(f'{self._entry_prefix(image_path)}_*.npy'):
+            try:
+                size = os.path.getsize(stale_path)
+                os.remove(stale_path)
+            except FileNotFoundError:
+                continue
+            with self._lock:
+                if self._total_bytes is not None:
+                    self._total_bytes -= size
+
+    def _list_entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for entry_path in glob.glob(os.path.join(self.cache_folder, '*', '*.npy')):
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+    def _evict_if_needed(self):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._list_entries())
+            if self._total_bytes <= self.max_bytes:
+                return
+
+            # Remove the least recently used entries until the cache is at 90% of its size
+            entries = sorted(self._list_entries())
+            total_bytes = sum(size for _, size, _ in entries)
+            target_bytes = int(self.max_bytes * 0.9)
+            evicted = 0
+            for _, size, entry_path in entries:
+                if total_bytes <= target_bytes:
+                    break
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+                evicted += 1
+            self._total_bytes = total_bytes
+            logger.info(f'Tensor cache evicted {evicted} entries, size: {total_bytes} bytes')
+
+    def stats(self) -> dict:
+        """
+        Get the hit/miss counters and the size of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size_bytes': self._total_bytes, 'max_bytes': self.max_bytes}
+
+
+tensor_cache = TensorCache()
+
+
+def warm_up(session_id: int = None, image_paths: list[str] = None) -> int:
+    """
+    Decode and cache the images of a session (or the given paths) ahead of training or inference.
+    Return the amount of images decoded.
+    """
+    # Tensorflow is needed to decode the same way as the training pipeline
+    import classifier.classifier as clf
+    import db.db_funcs as dbf
+    from settings.config import INPUT_IMAGE_FOLDER
+
+    if image_paths is None:
+        image_paths = [INPUT_IMAGE_FOLDER + '/' + name for name in dbf.get_img_names_from_session(db_file, session_id)]
+
+    decoded = 0
+    start = time.time()
+    for image_path in image_paths:
+        if tensor_cache.get(image_path) is not None:
+            continue
+        try:
+            tensor_cache.put(image_path, clf.decode_and_resize_uint8(image_path))
+            decoded += 1
+        except Exception as _:
+            logger.error(f'Could not cache image: {image_path}', exc_info=True)
+    logger.info(f'Tensor cache warm up: {decoded} images decoded in {time.time() - start:.1f}s')
+    return decoded
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Decode and cache the images of a session.')
+    parser.add_argument('--session', type=int, required=True, help='session id to warm up')
+    args = parser.parse_args()
+    warm_up(session_id=args.session)
@@ -0,0 +1,203 @@
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+
+from settings.config import log_config, TRAIN_CHECKPOINT_FOLDER
+import db.db_funcs as dbf
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+ACTIVE_STATUSES = ['queued', 'running']
+TRAINING_MODES = ['model', 'head']
+MIN_TRAINING_IMAGES = 32 + 1 # Same as classifier.batch_size + 1, without importing tensorflow in the web process
+
+
+def _pid_alive(pid: int) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True # Exists, owned by another user
+    return True
+
+def get_checkpoint_folder(session_id: int) -> str:
+    """
+    Folder of the per epoch checkpoint of the model training of a session.
+    """
+    return os.path.join(TRAIN_CHECKPOINT_FOLDER, f'session_{session_id}')
+
+
+def _run_training_job(db_filepath: str, job_id: int, session_id: int, full_train: bool, mode: str = 'model'):
+    """
+    Entry point of the training process. Reports the progress of each epoch to the training_job table.
+    """
+    # Tensorflow is only imported in the training process
+    import tensorflow as tf
+    import classifier.classifier as clf
+
+    class EpochProgressCallback(tf.keras.callbacks.Callback):
+        def __init__(self):
+            super().__init__()
+            self.progress = []
+            self.epoch_start = None
+            self.batches = 0
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.epoch_start = time.time()
+            self.batches = 0
+
+        def on_train_batch_end(self, batch, logs=None):
+            self.batches += 1
+
+        def on_epoch_end(self, epoch, logs=None):
+            seconds = time.time() - self.epoch_start
+            epoch_data = {key: float(value) for key, value in (logs or {}).items()}
+            epoch_data['epoch'] = epoch + 1
+            epoch_data['seconds'] = round(seconds, 3)
+            epoch_data['images_per_second'] = round(self.batches * clf.batch_size / seconds, 2) if seconds else None
+            self.progress.append(epoch_data)
+            dbf.update_training_job(db_filepath, job_id, progress=self.progress)
+
+    dbf.update_training_job(db_filepath, job_id, status='running', started=time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()))
+    try:
+        if mode == 'head':
+            import classifier.embeddings as embeddings
+            embeddings.train_head_by_session(db_filepath, session_id, callbacks=[EpochProgressCallback()])
+        else:
+            clf.train_model_by_session(db_filepath, session_id, full_train=full_train, callbacks=[EpochProgressCallback()])
+    except Exception as e:
+        logger.error(f'Training job {job_id} failed', exc_info=True)
+        dbf.set_training_job_finished(db_filepath, job_id, 'failed', error=f'{e}\n{traceback.format_exc()}')
+        return
+    dbf.set_training_job_finished(db_filepath, job_id, 'finished')
+
+
+class TrainingJobManager:
+    """
+    Runs the model training of each session in a separate process, so the web server keeps serving requests.
+    The state of the jobs is kept in the training_job table.
+    """
+
+    def __init__(self, db_filepath: str):
+        self.db_filepath = db_filepath
+        self._processes = {} # job_id -> multiprocessing.Process
+        self._lock = threading.Lock()
+        # Spawn instead of fork, so the child doesn't inherit the server threads or a half initialized tensorflow
+        self._context = multiprocessing.get_context('spawn')
+        # The spawned training process imports the server module again, it must not touch the jobs table
+        if multiprocessing.parent_process() is None:
+            self._mark_interrupted_jobs()
+
+    def _mark_interrupted_jobs(self):
+        # Jobs left active by a previous server run have no process anymore. Other server processes sharing the
+        # database may still be running theirs, so only the jobs whose process is gone are marked.
+        # The ones with an epoch checkpoint are marked interrupted, resume() continues them from it
+        for job in dbf.get_training_jobs(self.db_filepath, statuses=ACTIVE_STATUSES):
+            if not _pid_alive(job['pid']):
+                self._set_interrupted(job, 'Interrupted by a server restart')
+
+    def _set_interrupted(self, job: dict, reason: str):
+        # A job stopped without finishing is 'interrupted' if it can be resumed from an epoch checkpoint, 'failed' otherwise
+        checkpoint_folder = get_checkpoint_folder(job['session_id'])
+        if job['mode'] == 'model' and os.path.exists(os.path.join(checkpoint_folder, 'state.json')):
+            dbf.set_training_job_finished(self.db_filepath, job['job_id'], 'interrupted', error=f'{reason}, can be resumed from its checkpoint')
+            dbf.update_training_job(self.db_filepath, job['job_id'], checkpoint=checkpoint_folder)
+        else:
+            dbf.set_training_job_finished(self.db_filepath, job['job_id'], 'failed', error=reason)
+
+    def submit(self, session_id: int, full_train: bool = False, mode: str = 'model') -> int:
+        """
+        Start a training job for the session and return its id. In 'head' mode only the output layer is trained,
+        on the cached embeddings of every labeled image.
+        Raises ValueError if the session can't be trained right now.
+        """
+        if mode not in TRAINING_MODES:
+            raise ValueError(f"Unknown training mode: {mode}")
+        self._reap()
+        if dbf.get_training_jobs(self.db_filepath, session_id=session_id, statuses=ACTIVE_STATUSES):
+            raise ValueError("A model is already being trained for this session")
+
+        if not full_train and mode == 'model' and not dbf.get_unprocessed_labeled_images(self.db_filepath, session_id):
+            raise ValueError("No new labeled images to train")
+        # Incremental training replays older labels, every labeled image counts
+        if len(dbf.get_all_labeled_images(self.db_filepath, session_id)) < MIN_TRAINING_IMAGES:
+            raise ValueError("Too few labeled images to train")
+
+        job_id = dbf.new_training_job(self.db_filepath, session_id, full_train, mode)
+        process = self._context.Process(target=_run_training_job, args=(self.db_filepath, job_id, session_id, full_train, mode),
+                                        name=f'training-job-{job_id}', daemon=True)
+        process.start()
+        dbf.update_training_job(self.db_filepath, job_id, pid=process.pid)
+        with self._lock:
+            self._processes[job_id] = process
+        logger.info(f'Training job {job_id} started for session {session_id}, pid: {process.pid}')
+        return job_id
+
+    def resume(self, job_id: int) -> int:
+        """
+        Start a new job with the settings of an interrupted one, it continues from the checkpoint of the last epoch
+        if the labeled images didn't change since. Return the id of the new job.
+        Raises ValueError if the job was not interrupted.
+        """
+        job = dbf.get_training_job(self.db_filepath, job_id)
+        if not job or job['status'] != 'interrupted':
+            raise ValueError("Only interrupted jobs can be resumed")
+        new_job_id = self.submit(job['session_id'], full_train=job['full_train'], mode=job['mode'])
+        dbf.update_training_job(self.db_filepath, job_id, status='resumed')
+        logger.info(f'Training job {job_id} resumed as job {new_job_id}')
+        return new_job_id
+
+    def status(self, job_id: int) -> dict:
+        """
+        Get the status and per epoch progress of a job.
+        """
+        self._reap()
+        return dbf.get_training_job(self.db_filepath, job_id)
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        Stop a running job. Return False if the job is not running.
+        """
+        if not self._stop(job_id):
+            return False
+        dbf.set_training_job_finished(self.db_filepath, job_id, 'cancelled')
+        logger.info(f'Training job {job_id} cancelled')
+        return True
+
+    def _stop(self, job_id: int) -> bool:
+        with self._lock:
+            process = self._processes.pop(job_id, None)
+        if process is None or not process.is_alive():
+            return False
+        process.terminate()
+        process.join(10)
+        return True
+
+    def shutdown(self):
+        """
+        Stop every running job, used when the server exits. They can be resumed from their checkpoint.
+        """
+        with self._lock:
+            job_ids = list(self._processes.keys())
+        for job_id in job_ids:
+            if self._stop(job_id):
+                self._set_interrupted(dbf.get_training_job(self.db_filepath, job_id), 'Stopped by the server exit')
+
+    def _reap(self):
+        # Processes that died without reporting (e.g. killed by the OS) are marked as interrupted or failed
+        with self._lock:
+            finished = [(job_id, p) for job_id, p in self._processes.items() if not p.is_alive()]
+            for job_id, _ in finished:
+                del self._processes[job_id]
+        for job_id, process in finished:
+            job = dbf.get_training_job(self.db_filepath, job_id)
+            if job and job['status'] in ACTIVE_STATUSES:
+                self._set_interrupted(job, f'Training process exited with code {process.exitcode}')
@@ -1,41 +1,103 @@
 import sqlite3
+import threading
 from contextlib import contextmanager
-from settings.config import log_config, INPUT_IMAGE_FOLDER
+from settings.config import log_config, INPUT_IMAGE_FOLDER, DB_BUSY_TIMEOUT_SECONDS, DB_CACHE_SIZE_KB
+from monitoring.metrics import span
 
 import logging, json
 from logging import config as logging_config
 logging_config.dictConfig(log_config)
 logger = logging.getLogger()
 
+# Each thread reuses its own connection per database file
+_local = threading.local()
+
+def _connect(db_filepath: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_filepath, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES, timeout=DB_BUSY_TIMEOUT_SECONDS)
+    # WAL lets readers work while a write is in progress, NORMAL sync is safe with WAL
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_SECONDS * 1000)}')
+    return conn
+
+def get_connection(db_filepath: str) -> sqlite3.Connection:
+    """
+    Get the connection of the current thread to the database, opening it if needed.
+    """
+    if not hasattr(_local, 'connections'):
+        _local.connections = {}
+        _local.transaction_depth = {}
+    conn = _local.connections.get(db_filepath)
+    if conn is None:
+        conn = _connect(db_filepath)
+        _local.connections[db_filepath] = conn
+    return conn
+
+def close_connections():
+    """
+    Close the connections of the current thread.
+    """
+    for conn in getattr(_local, 'connections', {}).values():
+        conn.close()
+    _local.connections = {}
+    _local.transaction_depth = {}
+
+def _in_transaction(db_filepath: str) -> bool:
+    return getattr(_local, 'transaction_depth', {}).get(db_filepath, 0) > 0
+
 @contextmanager
 def db_ops(db_filepath: str):
+    conn = get_connection(db_filepath)
+    # Inside transaction() the commit is left to the outermost block
+    in_transaction = _in_transaction(db_filepath)
+    cursor = conn.cursor()
     try:
-        conn = sqlite3.connect(db_filepath, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
-        cursor = conn.cursor()
-        yield cursor
-        conn.commit()
+        with span('db'):
+            yield cursor
+        if not in_transaction:
+            with span('db_commit'):
+                conn.commit()
     except Exception as _:
         logger.error('Exception while performing db operation', exc_info=True)
+        if not in_transaction:
+            conn.rollback()
         raise
     finally:
         cursor.close()
-        conn.close()
 
-def initialize_db(db_filepath: str) -> None:
+@contextmanager
+def transaction(db_filepath: str):
     """
-    Creates a connection to the database and creates the tables if they don't exist.
+    Group several db_funcs calls in a single transaction, committed at the end of the block.
     """
-    with db_ops(db_filepath) as cursor:
-        cursor.execute('CREATE TABLE IF NOT EXISTS session (session_id INTEGER PRIMARY KEY, '
-                       'completed BOOLEAN, last_updated TIMESTAMP, imgs_are_available BOOLEAN, img_total INT, img_processed INT, img_labeled INT DEFAULT (0), label_map TEXT)')
-        cursor.execute('CREATE TABLE IF NOT EXISTS image (img_id INTEGER PRIMARY KEY, name TEXT, '
-                       'session_id INT, processed BOOLEAN, label TEXT, FOREIGN KEY(session_id) REFERENCES session(session_id))')
-        cursor.execute('CREATE TABLE IF NOT EXISTS prediction (pred_id INTEGER PRIMARY KEY, name TEXT, '
-                       'label TEXT, processed BOOLEAN, session_id INT, FOREIGN KEY(session_id) REFERENCES session(session_id))')
-        cursor.execute('CREATE TABLE IF NOT EXISTS exc_error (exc_error_id INTEGER PRIMARY KEY, session_id INT, traceback TEXT, '
-                   'image_path TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY(session_id) REFERENCES session(session_id))')
+    conn = get_connection(db_filepath)
+    depth = _local.transaction_depth.get(db_filepath, 0)
+    if depth == 0:
+        # Take the write lock up front so the reads in the block see the data being written
+        conn.execute('BEGIN IMMEDIATE')
+    _local.transaction_depth[db_filepath] = depth + 1
+    try:
+        yield conn
+        if depth == 0:
+            with span('db_commit'):
+                conn.commit()
+    except Exception as _:
+        if depth == 0:
+            conn.rollback()
+        raise
+    finally:
+        _local.transaction_depth[db_filepath] = depth
 
-        logger.info('Database initialized')
+def initialize_db(db_filepath: str) -> None:
+    """
+    Creates a connection to the database and creates or upgrades the tables.
+    """
+    # Imported here since migrations uses db_ops
+    from db.migrations import migrate
+    version = migrate(db_filepath)
+    logger.info(f'Database initialized, schema version: {version}')
 
 # TODO: Remove if not used
 def get_new_session_id(db_filepath: str) -> int:
@@ -62,14 +124,17 @@ def initialize_images_session(db_filepath: str, images: list[str], session_id: i
                            'VALUES (?, ?, ?, ?)', img_array)
         logger.info(f'Images initialized for session: {session_id}')
 
+# The hot queries are module constants, db.migrations checks their query plans
+RANDOM_UNLABELED_IMAGE_QUERY = "SELECT name FROM image WHERE session_id=? AND coalesce(label, '') = '' ORDER BY sample_key LIMIT 1"
+
 def obtain_random_unlabeled_image(db_filepath: str, session_id: int) -> str:
     """
     Obtain a random unlabeled image.
+    Every image gets a random sample_key when inserted, so the unlabeled image with the lowest key is a uniform
+    random pick that is read from the index instead of sorting all the unlabeled images.
     """
-    query = '''SELECT name FROM image WHERE img_id IN 
-            (SELECT img_id FROM image WHERE session_id=? AND coalesce(label, '') = '' ORDER BY RANDOM() LIMIT 1)'''
     with db_ops(db_filepath) as cursor:
-        cursor.execute(query, (session_id,))
+        cursor.execute(RANDOM_UNLABELED_IMAGE_QUERY, (session_id,))
         image = cursor.fetchone()
         print(image)
         if image is not None:
@@ -84,33 +149,99 @@ def obtain_unlabeled_images_from_session(db_filepath: str, session_id: int) -> l
     Obtain all unlabeled images from a session.
     """
     with db_ops(db_filepath) as cursor:
-        cursor.execute('SELECT name FROM image WHERE session_id=? AND coalesce(label, "") = ""', (session_id,))
+        cursor.execute("SELECT name FROM image WHERE session_id=? AND coalesce(label, '') = ''", (session_id,))
         rows = cursor.fetchall()
         img_list = [row[0] for row in rows]
         return img_list
         
+UNPREDICTED_IMAGES_QUERY = '''SELECT name FROM image WHERE session_id=? AND coalesce(label, '') = ''
+    AND NOT EXISTS (SELECT 1 FROM prediction p WHERE p.session_id = image.session_id AND p.name = image.name AND p.processed = 0
+        AND coalesce(p.model_version, 0) = ?)
+    AND NOT EXISTS (SELECT 1 FROM exc_error e WHERE e.session_id = image.session_id AND e.image_path = ? || image.name)'''
+
+def obtain_unpredicted_images_from_session(db_filepath: str, session_id: int, model_version: int = 0) -> list[str]:
+    """
+    Obtain the unlabeled images from a session that need a prediction of the given model version:
+    the ones never predicted and the ones predicted by another version.
+    Images quarantined in exc_error because they could not be decoded are left out.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute(UNPREDICTED_IMAGES_QUERY, (session_id, model_version, INPUT_IMAGE_FOLDER + '/'))
+        rows = cursor.fetchall()
+        img_list = [row[0] for row in rows]
+        return img_list
+
+UPDATE_IMAGE_LABEL_QUERY = 'UPDATE image SET label=? WHERE name=? AND session_id=?'
+
 def update_image_label(db_filepath: str, session_id: int, filename: str, label: str):
     """
     Update the label of an image.
     """
     with db_ops(db_filepath) as cursor:
-        cursor.execute('UPDATE image SET label=? WHERE name=? AND session_id=?',
-                       (label, filename, session_id))
+        cursor.execute(UPDATE_IMAGE_LABEL_QUERY, (label, filename, session_id))
+
+SESSION_LABELED_COUNT_QUERY = 'SELECT img_labeled, img_total FROM session WHERE session_id=?'
 
 def update_session_labeled_count(db_filepath: str, session_id: int):
     """
-    Update the count of labeled images in a session.
+    Get the count of labeled and total images in a session.
+    The counters are kept up to date by triggers on the image table, see rebuild_session_counters.
     """
     with db_ops(db_filepath) as cursor:
-        cursor.execute("SELECT COUNT(*) FROM image WHERE session_id=? AND not coalesce(label, '') = ''", (session_id,))
-        labeled_count = cursor.fetchone()[0]
-        cursor.execute('SELECT COUNT(*) FROM image WHERE session_id=? AND processed = true', (session_id,))
-        processed_count = cursor.fetchone()[0]
-        cursor.execute('SELECT COUNT(*) FROM image WHERE session_id=?', (session_id,))
-        total_count = cursor.fetchone()[0]
-        cursor.execute('UPDATE session SET img_labeled=?, img_total=?, img_processed=? WHERE session_id=?', (labeled_count, total_count, processed_count, session_id))
+        cursor.execute(SESSION_LABELED_COUNT_QUERY, (session_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return 0, 0
+        labeled_count, total_count = row
         return labeled_count, total_count
 
+def rebuild_session_counters(db_filepath: str, session_id: int = None):
+    """
+    Recompute the session counters and class histogram from the image rows, of one session or all of them.
+    """
+    session_filter = '' if session_id is None else 'WHERE session_id=?'
+    params = () if session_id is None else (session_id,)
+    with transaction(db_filepath):
+        with db_ops(db_filepath) as cursor:
+            cursor.execute(f'DELETE FROM session_label_count {session_filter}', params)
+            cursor.execute("INSERT INTO session_label_count(session_id, label, amount) "
+                           f"SELECT session_id, coalesce(label, ''), COUNT(*) FROM image {session_filter} GROUP BY session_id, coalesce(label, '')", params)
+            cursor.execute(f"""UPDATE session SET
+                img_total = (SELECT COUNT(*) FROM image WHERE image.session_id = session.session_id),
+                img_labeled = (SELECT COUNT(*) FROM image WHERE image.session_id = session.session_id AND coalesce(label, '') != ''),
+                img_processed = (SELECT COUNT(*) FROM image WHERE image.session_id = session.session_id AND processed = 1)
+                {session_filter}""", params)
+    logger.info(f'Session counters rebuilt for session: {session_id if session_id is not None else "all"}')
+
+def check_session_counters(db_filepath: str) -> list[dict]:
+    """
+    Compare the session counters and class histogram with the image rows.
+    Return the sessions that are out of sync.
+    """
+    query = '''
+            SELECT s.session_id, s.img_total, s.img_labeled, s.img_processed,
+                (SELECT COUNT(*) FROM image i WHERE i.session_id = s.session_id),
+                (SELECT COUNT(*) FROM image i WHERE i.session_id = s.session_id AND coalesce(i.label, '') != ''),
+                (SELECT COUNT(*) FROM image i WHERE i.session_id = s.session_id AND i.processed = 1)
+            FROM session s
+            '''
+    histogram_query = '''
+            SELECT coalesce(label, ''), COUNT(*) FROM image WHERE session_id=? GROUP BY coalesce(label, '')
+            '''
+    mismatches = []
+    with db_ops(db_filepath) as cursor:
+        cursor.execute(query)
+        for row in cursor.fetchall():
+            stored, actual = row[1:4], row[4:7]
+            cursor.execute(histogram_query, (row[0],))
+            actual_histogram = {label: amount for label, amount in cursor.fetchall()}
+            cursor.execute('SELECT label, amount FROM session_label_count WHERE session_id=? AND amount != 0', (row[0],))
+            stored_histogram = {label: amount for label, amount in cursor.fetchall()}
+            if tuple(stored) != tuple(actual) or stored_histogram != actual_histogram:
+                mismatches.append({'session_id': row[0], 'stored': list(stored), 'actual': list(actual),
+                                   'stored_histogram': stored_histogram, 'actual_histogram': actual_histogram})
+    return mismatches
+
 def get_sessions(db_filepath: str, **kwargs) -> list[dict]:
     """
     Get the sessions from the database. 
@@ -163,6 +294,7 @@ def get_image_classes(db_filepath: str, session_id: int) -> list[str]:
 def new_session(db_filepath: str, img_total: int, img_processed: int, img_available: bool = False, img_labeled: int = 0) -> int:
     """
     Create a new session in the database.
+    The image counters are added to as the images of the session are inserted.
     """
     with db_ops(db_filepath) as cursor:
         cursor.execute('INSERT INTO session(completed, last_updated, imgs_are_available, img_total, img_processed, img_labeled) '
@@ -185,12 +317,14 @@ def set_session_imgs_available(db_filepath: str, session_id: int):
     with db_ops(db_filepath) as cursor:
         cursor.execute('UPDATE session SET imgs_are_available=? WHERE session_id=?', (True, session_id))
 
+SESSION_STATS_QUERY = 'SELECT label, amount FROM session_label_count WHERE session_id=? AND amount > 0 ORDER BY label'
+
 def get_stats_from_session(db_filepath: str, session_id: int) -> dict:
     """
     Get the stats from a session.
     """
     with db_ops(db_filepath) as cursor:
-        cursor.execute("select label as img_class, sum(1) as img_amount  from image where image.session_id = ? group by label;", (session_id,))
+        cursor.execute(SESSION_STATS_QUERY, (session_id,))
         rows = cursor.fetchall()
         r = []
         for row in rows:
@@ -258,48 +392,97 @@ def jsonKeys2int(x):
         return {int(k):v for k,v in x.items()}
     return x
     
-def add_prediction(db_filepath: str, filename: str, label: str, session_id: int):
+# An image has a single prediction, a new one replaces it and puts it back in the queue
+UPSERT_PREDICTION = '''INSERT INTO prediction(name, label, session_id, processed, model_version) VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(session_id, name) DO UPDATE SET label=excluded.label, processed=excluded.processed, model_version=excluded.model_version'''
+
+def add_prediction(db_filepath: str, filename: str, label: str, session_id: int, model_version: int = 0):
+    """
+    Add or replace the prediction of an image.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute(UPSERT_PREDICTION, (filename, label, session_id, False, model_version))
+
+def add_predictions(db_filepath: str, predictions: list[tuple[str, str]], session_id: int, model_version: int = 0):
     """
-    Add a new prediction to the database.
+    Add or replace a batch of (filename, label) predictions made by a model version in a single transaction.
     """
+    if not predictions:
+        return
     with db_ops(db_filepath) as cursor:
-        cursor.execute('INSERT INTO prediction(name, label, session_id, processed) VALUES (?, ?, ?, ?)', (filename, label, session_id, False))
+        cursor.executemany(UPSERT_PREDICTION, [(filename, label, session_id, False, model_version) for filename, label in predictions])
+
+SET_PREDICTION_PROCESSED_QUERY = 'UPDATE prediction SET processed=? WHERE name=? AND session_id=?'
 
 def set_prediction_processed(db_filepath: str, filename: str, session_id: int):
     """
     Set a prediction as processed.
     """
     with db_ops(db_filepath) as cursor:
-        cursor.execute('UPDATE prediction SET processed=? WHERE name=? AND session_id=?', (True, filename, session_id))
+        cursor.execute(SET_PREDICTION_PROCESSED_QUERY, (True, filename, session_id))
+
+UNPROCESSED_PREDICTION_QUERY = '''
+    WITH unprocessed_count AS (
+        SELECT label, COUNT(*) AS unprocessed_total
+        FROM prediction
+        WHERE session_id = ? AND processed = 0 AND name IS NOT NULL AND name != ""
+        GROUP BY label
+        HAVING unprocessed_total > 0
+        ORDER BY unprocessed_total ASC
+        LIMIT 1
+    )
+    SELECT name, label
+    FROM prediction
+    WHERE session_id=? AND processed = 0 AND name IS NOT NULL AND name != ""
+    AND label = (SELECT label FROM unprocessed_count)
+    LIMIT 1
+    '''
 
 def get_unprocessed_prediction(db_filepath: str, session_id: int) -> tuple[str, str]:
     """
     Get single unprocessed prediction from the database. The prediction is ordered by label. The group with least labels come first.
     """
-
+    with db_ops(db_filepath) as cursor:
+        cursor.execute(UNPROCESSED_PREDICTION_QUERY, (session_id, session_id))
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0], row[1] # filename, label
+        return None, None
+    
+def get_next_unprocessed_predictions(db_filepath: str, session_id: int, amount: int) -> list[str]:
+    """
+    Get the names of the next unprocessed predictions, following the same order as get_unprocessed_prediction.
+    """
     query = '''
             WITH unprocessed_count AS (
                 SELECT label, COUNT(*) AS unprocessed_total
                 FROM prediction
                 WHERE session_id = ? AND processed = 0 AND name IS NOT NULL AND name != ""
                 GROUP BY label
-                HAVING unprocessed_total > 0
-                ORDER BY unprocessed_total ASC
-                LIMIT 1
             )
-            SELECT name, label
-            FROM prediction
-            WHERE session_id=? AND processed=? AND name IS NOT NULL AND name != ""
-            AND label = (SELECT label FROM unprocessed_count)
-            LIMIT 1
+            SELECT prediction.name
+            FROM prediction JOIN unprocessed_count ON prediction.label = unprocessed_count.label
+            WHERE session_id=? AND processed=0 AND name IS NOT NULL AND name != ""
+            ORDER BY unprocessed_count.unprocessed_total ASC, prediction.pred_id ASC
+            LIMIT ?
             '''
     with db_ops(db_filepath) as cursor:
-        cursor.execute(query, (session_id, session_id, False))
-        row = cursor.fetchone()
-        if row is not None:
-            return row[0], row[1] # filename, label
-        return None, None
-    
+        cursor.execute(query, (session_id, session_id, amount))
+        return [row[0] for row in cursor.fetchall()]
+
+def count_unprocessed_predictions(db_filepath: str, session_id: int, model_version: int = None) -> int:
+    """
+    Count the predictions of a session that are still waiting to be labeled, only the ones of a model version if given.
+    """
+    query = 'SELECT COUNT(*) FROM prediction WHERE session_id=? AND processed=0 AND name IS NOT NULL AND name != ""'
+    params = (session_id,)
+    if model_version is not None:
+        query += ' AND coalesce(model_version, 0) = ?'
+        params += (model_version,)
+    with db_ops(db_filepath) as cursor:
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
 def new_exc_error(db_filepath: str, session_id: int, traceback: str, image_path: str = None):
     """
     Add a new exception error to the database.
@@ -315,4 +498,159 @@ def get_errored_images_by_session(db_filepath: str, session_id: int) -> list[dic
         cursor.execute('SELECT traceback, image_path, timestamp FROM exc_error WHERE session_id=? AND image_path IS NOT NULL AND image_path != ""', (session_id,))
         rows = cursor.fetchall()
         error_list = [{'traceback': row[0], 'image_path': row[1], 'timestamp': row[2]} for row in rows]
-        return error_list
\ No newline at end of file
+        return error_list
+
+## Training jobs
+def new_training_job(db_filepath: str, session_id: int, full_train: bool, mode: str = 'model') -> int:
+    """
+    Create a new queued training job.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute('INSERT INTO training_job(session_id, full_train, status, progress, mode) VALUES (?, ?, ?, ?, ?)',
+                       (session_id, full_train, 'queued', json.dumps([]), mode))
+        return cursor.lastrowid
+
+def update_training_job(db_filepath: str, job_id: int, **kwargs):
+    """
+    Update the given columns of a training job. The progress is stored as json.
+    """
+    if 'progress' in kwargs:
+        kwargs['progress'] = json.dumps(kwargs['progress'])
+    columns = ', '.join([f'{key}=?' for key in kwargs])
+    with db_ops(db_filepath) as cursor:
+        cursor.execute(f'UPDATE training_job SET {columns} WHERE job_id=?', (*kwargs.values(), job_id))
+
+def set_training_job_finished(db_filepath: str, job_id: int, status: str, error: str = None):
+    """
+    Set the final status of a training job.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute('UPDATE training_job SET status=?, error=?, finished=CURRENT_TIMESTAMP WHERE job_id=?', (status, error, job_id))
+
+def get_training_job(db_filepath: str, job_id: int) -> dict:
+    """
+    Get a training job and its per epoch progress.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute('SELECT job_id, session_id, full_train, status, pid, progress, error, created, started, finished, mode, checkpoint '
+                       'FROM training_job WHERE job_id=?', (job_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return {'job_id': row[0], 'session_id': row[1], 'full_train': row[2] > 0, 'status': row[3], 'pid': row[4],
+                'progress': json.loads(row[5]) if row[5] else [], 'error': row[6], 'created': row[7], 'started': row[8], 'finished': row[9],
+                'mode': row[10], 'checkpoint': row[11]}
+
+def get_training_jobs(db_filepath: str, session_id: int = None, statuses: list[str] = None) -> list[dict]:
+    """
+    Get the training jobs, optionally filtered by session and status.
+    """
+    query = 'SELECT job_id FROM training_job WHERE 1=1'
+    params = []
+    if session_id is not None:
+        query += ' AND session_id=?'
+        params.append(session_id)
+    if statuses:
+        query += f' AND status IN ({",".join("?" * len(statuses))})'
+        params.extend(statuses)
+    with db_ops(db_filepath) as cursor:
+        cursor.execute(query + ' ORDER BY job_id DESC', params)
+        job_ids = [row[0] for row in cursor.fetchall()]
+    return [get_training_job(db_filepath, job_id) for job_id in job_ids]
+
+
+## Input folder index
+def get_file_index(db_filepath: str) -> dict[str, tuple[int, int, int]]:
+    """
+    Get the indexed files of the input folder as name -> (size, mtime_ns, inode).
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute('SELECT name, size, mtime_ns, inode FROM file_index')
+        return {row[0]: (row[1], row[2], row[3]) for row in cursor.fetchall()}
+
+def update_file_index(db_filepath: str, changed: list[tuple[str, int, int, int]], removed: list[str]):
+    """
+    Insert or update the changed (name, size, mtime_ns, inode) files and delete the removed ones.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.executemany('INSERT INTO file_index(name, size, mtime_ns, inode) VALUES (?, ?, ?, ?) '
+                           'ON CONFLICT(name) DO UPDATE SET size=excluded.size, mtime_ns=excluded.mtime_ns, '
+                           'inode=excluded.inode, last_changed=CURRENT_TIMESTAMP, '
+                           # The content may have changed, the hash is computed again
+                           'phash=CASE WHEN size=excluded.size AND mtime_ns=excluded.mtime_ns THEN phash END', changed)
+        cursor.executemany('DELETE FROM file_index WHERE name=?', [(name,) for name in removed])
+
+def reconcile_session_with_file_index(db_filepath: str, session_id: int) -> bool:
+    """
+    Add the indexed files missing in a session, as long as every image of the session is still in the folder.
+    Return True if all the images of the session are available.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute('SELECT COUNT(*) FROM image WHERE session_id=? AND name NOT IN (SELECT name FROM file_index)', (session_id,))
+        if cursor.fetchone()[0] > 0:
+            # Some images in the database are not in the folder
+            return False
+        cursor.execute('INSERT INTO image(name, session_id, processed, label) '
+                       'SELECT name, ?, ?, ? FROM file_index WHERE name NOT IN (SELECT name FROM image WHERE session_id=?)',
+                       (session_id, False, '', session_id))
+        if cursor.rowcount > 0:
+            logger.info(f'{cursor.rowcount} new images added to session: {session_id}')
+        return True
+
+def new_session_from_file_index(db_filepath: str) -> int:
+    """
+    Create a new session with every indexed file of the input folder.
+    """
+    with transaction(db_filepath):
+        # The counters grow with each inserted image
+        session_id = new_session(db_filepath, 0, 0, True)
+        with db_ops(db_filepath) as cursor:
+            cursor.execute('INSERT INTO image(name, session_id, processed, label) SELECT name, ?, ?, ? FROM file_index',
+                           (session_id, False, ''))
+        logger.info(f'Images initialized for session: {session_id}')
+    return session_id
+
+## Perceptual hashes
+def get_unhashed_files(db_filepath: str, limit: int) -> list[str]:
+    """
+    Get indexed files whose perceptual hash is not computed yet.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute('SELECT name FROM file_index WHERE phash IS NULL LIMIT ?', (limit,))
+        return [row[0] for row in cursor.fetchall()]
+
+def set_file_hashes(db_filepath: str, hashes: list[tuple[str, int]]):
+    """
+    Store the (name, phash) of indexed files.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.executemany('UPDATE file_index SET phash=? WHERE name=?', [(phash, name) for name, phash in hashes])
+
+def get_file_hashes(db_filepath: str) -> dict[str, int]:
+    """
+    Get the perceptual hash of every indexed file that has one, as name -> phash.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute('SELECT name, phash FROM file_index WHERE phash IS NOT NULL')
+        return dict(cursor.fetchall())
+
+def get_file_hashes_signature(db_filepath: str) -> tuple[int, str]:
+    """
+    Cheap signature that changes when hashes are added or files change, to know when to rebuild the duplicate index.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.execute('SELECT COUNT(phash), MAX(last_changed) FROM file_index')
+        return tuple(cursor.fetchone())
+
+def label_unlabeled_images(db_filepath: str, session_id: int, filenames: list[str], label: str) -> int:
+    """
+    Label the given images of a session that have no label yet and remove them from the prediction queue.
+    Return the amount of images labeled.
+    """
+    with db_ops(db_filepath) as cursor:
+        cursor.executemany("UPDATE image SET label=? WHERE name=? AND session_id=? AND coalesce(label, '') = ''",
+                           [(label, filename, session_id) for filename in filenames])
+        labeled = cursor.rowcount
+        cursor.executemany('UPDATE prediction SET processed=? WHERE name=? AND session_id=?',
+                           [(True, filename, session_id) for filename in filenames])
+        return labeled
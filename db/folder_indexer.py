@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+from settings.config import log_config, INPUT_IMAGE_FOLDER, INDEX_POLL_SECONDS, INDEX_FULL_RESCAN_SECONDS, DEDUP_ENABLED
+import db.db_funcs as dbf
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+ACCEPTED_EXTENSIONS = ['.apng', '.avif', '.gif', '.jpg', '.jpeg', '.jfif', '.pjpeg', '.pjp', '.png', '.svg', '.webp', '.bmp']
+
+
+class FolderIndexer:
+    """
+    Keeps the file_index table in sync with the input folder and the sessions in sync with the index.
+    The folder is only scanned again when its mtime changes (files added, removed or renamed) or after
+    INDEX_FULL_RESCAN_SECONDS, to also catch files modified in place.
+    """
+
+    def __init__(self, db_filepath: str, folder: str = INPUT_IMAGE_FOLDER, poll_seconds: float = INDEX_POLL_SECONDS,
+                 full_rescan_seconds: float = INDEX_FULL_RESCAN_SECONDS):
+        self.db_filepath = db_filepath
+        self.folder = folder
+        self.poll_seconds = poll_seconds
+        self.full_rescan_seconds = full_rescan_seconds
+        self._folder_mtime_ns = None
+        self._last_scan = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.scans = 0
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Scan the folder if it changed since the last scan and update the sessions.
+        Return True if a scan was done.
+        """
+        with self._lock:
+            folder_mtime_ns = os.stat(self.folder).st_mtime_ns
+            rescan_due = time.time() - self._last_scan > self.full_rescan_seconds
+            if not force and not rescan_due and folder_mtime_ns == self._folder_mtime_ns:
+                return False
+
+            changed, removed = self._scan()
+            # The sessions also have to be checked on the first scan, a session could be missing
+            if changed or removed or self._folder_mtime_ns is None:
+                self._reconcile_sessions()
+            self._folder_mtime_ns = folder_mtime_ns
+            self._last_scan = time.time()
+            return True
+
+    def _scan(self) -> tuple[list[tuple[str, int, int, int]], list[str]]:
+        indexed = dbf.get_file_index(self.db_filepath)
+        seen = set()
+        changed = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[1].lower() not in ACCEPTED_EXTENSIONS: # Filter out non-image files
+                    continue
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                seen.add(entry.name)
+                file_data = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+                if indexed.get(entry.name) != file_data:
+                    changed.append((entry.name, *file_data))
+        removed = [name for name in indexed if name not in seen]
+
+        if changed or removed:
+            dbf.update_file_index(self.db_filepath, changed, removed)
+            logger.info(f'Input folder index updated: {len(changed)} new or changed, {len(removed)} removed')
+        self.scans += 1
+        return changed, removed
+
+    def _reconcile_sessions(self):
+        with dbf.transaction(self.db_filepath):
+            dbf.set_not_available(self.db_filepath)
+            any_available = False
+            for session in dbf.get_sessions(self.db_filepath):
+                if dbf.reconcile_session_with_file_index(self.db_filepath, session['session_id']):
+                    dbf.set_session_imgs_available(self.db_filepath, session['session_id'])
+                    any_available = True
+
+        if not any_available:
+            # No session has all of its images in the folder
+            dbf.new_session_from_file_index(self.db_filepath)
+
+    def start(self):
+        """
+        Watch the folder in the background, polling its mtime every poll_seconds.
+        """
+        if self.poll_seconds <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='folder-indexer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching the folder.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(self.poll_seconds + 5)
+
+    def _run(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.refresh()
+            except Exception as _:
+                logger.error('Error refreshing the input folder index', exc_info=True)
+            if DEDUP_ENABLED:
+                self.hash_pending()
+
+    def hash_pending(self) -> int:
+        """
+        Compute the perceptual hashes of a batch of new or changed files, in the background after the folder is indexed.
+        """
+        from dedup.duplicates import hash_pending_files
+        try:
+            hashed = hash_pending_files(self.db_filepath)
+        except Exception as _:
+            logger.error('Error hashing the input folder images', exc_info=True)
+            return 0
+        if hashed:
+            logger.info(f'{hashed} images hashed')
+        return hashed
+
+    def status(self) -> dict:
+        """
+        Get the state of the indexer.
+        """
+        return {'watching': self._thread is not None and self._thread.is_alive(), 'scans': self.scans,
+                'last_scan': self._last_scan, 'poll_seconds': self.poll_seconds}
@@ -0,0 +1,215 @@
+import argparse
+
+from settings.config import log_config, db_file
+import db.db_funcs as dbf
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+# Each migration upgrades the schema to its version, the current version is stored in PRAGMA user_version.
+# Never edit a released migration, add a new one instead.
+MIGRATIONS = [
+    (1, 'Base tables', [
+        'CREATE TABLE IF NOT EXISTS session (session_id INTEGER PRIMARY KEY, '
+        'completed BOOLEAN, last_updated TIMESTAMP, imgs_are_available BOOLEAN, img_total INT, img_processed INT, img_labeled INT DEFAULT (0), label_map TEXT)',
+        'CREATE TABLE IF NOT EXISTS image (img_id INTEGER PRIMARY KEY, name TEXT, '
+        'session_id INT, processed BOOLEAN, label TEXT, FOREIGN KEY(session_id) REFERENCES session(session_id))',
+        'CREATE TABLE IF NOT EXISTS prediction (pred_id INTEGER PRIMARY KEY, name TEXT, '
+        'label TEXT, processed BOOLEAN, session_id INT, FOREIGN KEY(session_id) REFERENCES session(session_id))',
+        'CREATE TABLE IF NOT EXISTS exc_error (exc_error_id INTEGER PRIMARY KEY, session_id INT, traceback TEXT, '
+        'image_path TEXT, timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY(session_id) REFERENCES session(session_id))',
+    ]),
+    (2, 'Training jobs', [
+        'CREATE TABLE IF NOT EXISTS training_job (job_id INTEGER PRIMARY KEY, session_id INT, full_train BOOLEAN, '
+        'status TEXT, pid INT, progress TEXT, error TEXT, created TIMESTAMP DEFAULT CURRENT_TIMESTAMP, '
+        'started TIMESTAMP, finished TIMESTAMP, FOREIGN KEY(session_id) REFERENCES session(session_id))',
+    ]),
+    (3, 'Indexes for the labeling and prediction queries', [
+        # Label updates and name lookups by session
+        'CREATE INDEX IF NOT EXISTS idx_image_session_name ON image(session_id, name)',
+        # Stats by label and labeled/processed counts, covering
+        'CREATE INDEX IF NOT EXISTS idx_image_session_label ON image(session_id, label, processed)',
+        # Only the unlabeled images, used to pick the next images to predict or label
+        "CREATE INDEX IF NOT EXISTS idx_image_unlabeled ON image(session_id, name) WHERE coalesce(label, '') = ''",
+        # Prediction queue: only the predictions waiting to be labeled
+        'CREATE INDEX IF NOT EXISTS idx_prediction_pending ON prediction(session_id, label, name) WHERE processed = 0',
+        'CREATE INDEX IF NOT EXISTS idx_prediction_session_name ON prediction(session_id, name)',
+        'CREATE INDEX IF NOT EXISTS idx_exc_error_session ON exc_error(session_id)',
+        'CREATE INDEX IF NOT EXISTS idx_training_job_session_status ON training_job(session_id, status)',
+    ]),
+    (4, 'Index of the files in the input folder', [
+        'CREATE TABLE IF NOT EXISTS file_index (name TEXT PRIMARY KEY, size INT, mtime_ns INT, inode INT, '
+        'first_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP, last_changed TIMESTAMP DEFAULT CURRENT_TIMESTAMP)',
+    ]),
+    (5, 'Per session counters and class histogram maintained by triggers', [
+        # Amount of images of each label in a session, unlabeled images are counted under ''
+        'CREATE TABLE IF NOT EXISTS session_label_count (session_id INT, label TEXT, amount INT, '
+        'PRIMARY KEY(session_id, label), FOREIGN KEY(session_id) REFERENCES session(session_id))',
+        """CREATE TRIGGER IF NOT EXISTS trg_image_insert_counts AFTER INSERT ON image BEGIN
+            INSERT INTO session_label_count(session_id, label, amount) VALUES (NEW.session_id, coalesce(NEW.label, ''), 1)
+                ON CONFLICT(session_id, label) DO UPDATE SET amount = amount + 1;
+            UPDATE session SET img_total = coalesce(img_total, 0) + 1,
+                img_labeled = coalesce(img_labeled, 0) + (coalesce(NEW.label, '') != ''),
+                img_processed = coalesce(img_processed, 0) + coalesce(NEW.processed = 1, 0)
+                WHERE session_id = NEW.session_id;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_image_delete_counts AFTER DELETE ON image BEGIN
+            UPDATE session_label_count SET amount = amount - 1 WHERE session_id = OLD.session_id AND label = coalesce(OLD.label, '');
+            UPDATE session SET img_total = img_total - 1,
+                img_labeled = img_labeled - (coalesce(OLD.label, '') != ''),
+                img_processed = img_processed - coalesce(OLD.processed = 1, 0)
+                WHERE session_id = OLD.session_id;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS trg_image_update_counts AFTER UPDATE OF label, processed, session_id ON image
+            WHEN coalesce(OLD.label, '') != coalesce(NEW.label, '') OR coalesce(OLD.processed = 1, 0) != coalesce(NEW.processed = 1, 0)
+                OR OLD.session_id != NEW.session_id BEGIN
+            UPDATE session_label_count SET amount = amount - 1 WHERE session_id = OLD.session_id AND label = coalesce(OLD.label, '');
+            INSERT INTO session_label_count(session_id, label, amount) VALUES (NEW.session_id, coalesce(NEW.label, ''), 1)
+                ON CONFLICT(session_id, label) DO UPDATE SET amount = amount + 1;
+            UPDATE session SET img_total = img_total - 1,
+                img_labeled = img_labeled - (coalesce(OLD.label, '') != ''),
+                img_processed = img_processed - coalesce(OLD.processed = 1, 0)
+                WHERE session_id = OLD.session_id;
+            UPDATE session SET img_total = img_total + 1,
+                img_labeled = img_labeled + (coalesce(NEW.label, '') != ''),
+                img_processed = img_processed + coalesce(NEW.processed = 1, 0)
+                WHERE session_id = NEW.session_id;
+        END""",
+        # Backfill from the existing images
+        'DELETE FROM session_label_count',
+        "INSERT INTO session_label_count(session_id, label, amount) "
+        "SELECT session_id, coalesce(label, ''), COUNT(*) FROM image GROUP BY session_id, coalesce(label, '')",
+        """UPDATE session SET
+            img_total = (SELECT COUNT(*) FROM image WHERE image.session_id = session.session_id),
+            img_labeled = (SELECT COUNT(*) FROM image WHERE image.session_id = session.session_id AND coalesce(label, '') != ''),
+            img_processed = (SELECT COUNT(*) FROM image WHERE image.session_id = session.session_id AND processed = 1)""",
+    ]),
+    (6, 'Random sample key to pick unlabeled images without sorting', [
+        # Each image gets a random key when inserted, so the unlabeled images ordered by key are a shuffled queue
+        'ALTER TABLE image ADD COLUMN sample_key INTEGER',
+        'UPDATE image SET sample_key = random()',
+        """CREATE TRIGGER IF NOT EXISTS trg_image_insert_sample_key AFTER INSERT ON image WHEN NEW.sample_key IS NULL BEGIN
+            UPDATE image SET sample_key = random() WHERE img_id = NEW.img_id;
+        END""",
+        "CREATE INDEX IF NOT EXISTS idx_image_unlabeled_sample ON image(session_id, sample_key) WHERE coalesce(label, '') = ''",
+    ]),
+    (7, 'Training mode of the jobs', [
+        # 'model' trains the whole model, 'head' only its output layer on cached embeddings
+        "ALTER TABLE training_job ADD COLUMN mode TEXT NOT NULL DEFAULT 'model'",
+    ]),
+    (8, 'Perceptual hash of the indexed files', [
+        # 64 bit difference hash stored as a signed integer, NULL until computed
+        'ALTER TABLE file_index ADD COLUMN phash INTEGER',
+        'CREATE INDEX IF NOT EXISTS idx_file_index_unhashed ON file_index(name) WHERE phash IS NULL',
+    ]),
+    (9, 'One prediction per image, tagged with the model version', [
+        # Registry version of the model that made the prediction, NULL for the ones made before (same as version 0)
+        'ALTER TABLE prediction ADD COLUMN model_version INTEGER',
+        # Refills inserted the same image again, keep its last prediction, processed if any of them was
+        'UPDATE prediction SET processed = 1 WHERE processed = 0 AND EXISTS (SELECT 1 FROM prediction p '
+        'WHERE p.session_id = prediction.session_id AND p.name = prediction.name AND p.processed = 1)',
+        'DELETE FROM prediction WHERE pred_id NOT IN (SELECT MAX(pred_id) FROM prediction GROUP BY session_id, name)',
+        'DROP INDEX IF EXISTS idx_prediction_session_name',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_prediction_session_name ON prediction(session_id, name)',
+    ]),
+    (10, 'Lookup of the quarantined images', [
+        # Images that could not be decoded are skipped by the prediction refills
+        'CREATE INDEX IF NOT EXISTS idx_exc_error_session_path ON exc_error(session_id, image_path)',
+    ]),
+    (11, 'Checkpoint of the interrupted training jobs', [
+        # Folder of the last epoch checkpoint of a job interrupted by a server restart, the job can be resumed from it
+        'ALTER TABLE training_job ADD COLUMN checkpoint TEXT',
+    ]),
+]
+
+# Hot queries of db_funcs that must not scan a whole table, with sample parameters
+HOT_QUERIES = {
+    'update_image_label': (dbf.UPDATE_IMAGE_LABEL_QUERY, ('', '', 1)),
+    'obtain_random_unlabeled_image': (dbf.RANDOM_UNLABELED_IMAGE_QUERY, (1,)),
+    'obtain_unpredicted_images_from_session': (dbf.UNPREDICTED_IMAGES_QUERY, (1, 0, '')),
+    'update_session_labeled_count': (dbf.SESSION_LABELED_COUNT_QUERY, (1,)),
+    'get_stats_from_session': (dbf.SESSION_STATS_QUERY, (1,)),
+    'set_prediction_processed': (dbf.SET_PREDICTION_PROCESSED_QUERY, (True, '', 1)),
+    'get_unprocessed_prediction': (dbf.UNPROCESSED_PREDICTION_QUERY, (1, 1)),
+}
+
+
+def get_schema_version(db_filepath: str) -> int:
+    """
+    Get the version of the schema of the database.
+    """
+    with dbf.db_ops(db_filepath) as cursor:
+        cursor.execute('PRAGMA user_version')
+        return cursor.fetchone()[0]
+
+def migrate(db_filepath: str) -> int:
+    """
+    Apply the pending migrations in order, each one in its own transaction. Return the final version.
+    """
+    version = get_schema_version(db_filepath)
+    for migration_version, description, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        with dbf.transaction(db_filepath) as conn:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {migration_version}')
+        logger.info(f'Database migrated to version {migration_version}: {description}')
+        version = migration_version
+
+    # Refresh the statistics the query planner uses to pick indexes
+    with dbf.db_ops(db_filepath) as cursor:
+        cursor.execute('PRAGMA optimize')
+    return version
+
+def check_query_plans(db_filepath: str) -> dict[str, list[str]]:
+    """
+    Get the query plan of each hot query and log the ones that scan a table without an index.
+    Return the name of the queries with a full scan and their plan.
+    """
+    full_scans = {}
+    with dbf.db_ops(db_filepath) as cursor:
+        for name, (query, params) in HOT_QUERIES.items():
+            cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+            plan = [row[3] for row in cursor.fetchall()]
+            # A 'SCAN table' without 'USING ... INDEX' reads every row of the table
+            scans = [step for step in plan if step.startswith('SCAN') and 'INDEX' not in step and 'CONSTANT ROW' not in step
+                     and 'unprocessed_count' not in step]
+            if scans:
+                full_scans[name] = plan
+                logger.error(f'Query {name} scans a full table: {plan}')
+            else:
+                logger.info(f'Query {name} uses indexes: {plan}')
+    return full_scans
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upgrade the database schema.')
+    parser.add_argument('--db', default=db_file, help='database file')
+    parser.add_argument('--check', action='store_true', help='check that the hot queries use the indexes of the schema')
+    parser.add_argument('--check-db', action='store_true',
+                        help='check the query plans with the statistics of the database file instead of an empty schema')
+    parser.add_argument('--check-counters', action='store_true', help='compare the session counters with the image rows')
+    parser.add_argument('--rebuild-counters', action='store_true', help='recompute the session counters from the image rows')
+    args = parser.parse_args()
+    print(f'Schema version: {migrate(args.db)}')
+    if args.rebuild_counters:
+        dbf.rebuild_session_counters(args.db)
+        print('Session counters rebuilt')
+    if args.check_counters:
+        mismatches = dbf.check_session_counters(args.db)
+        if mismatches:
+            raise SystemExit(f'Session counters out of sync: {mismatches}')
+        print('Session counters are consistent')
+    if args.check or args.check_db:
+        # An empty schema has no statistics, so the planner shows which indexes can serve each query.
+        # With the statistics of a real database a scan can be the right plan, e.g. when there is a single session
+        check_db = args.db if args.check_db else ':memory:'
+        if check_db == ':memory:':
+            migrate(check_db)
+        full_scans = check_query_plans(check_db)
+        if full_scans:
+            raise SystemExit(f'Queries scanning full tables: {", ".join(full_scans)}')
+        print('All hot queries use indexes')
@@ -0,0 +1,213 @@
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from settings.config import log_config, db_file, INPUT_IMAGE_FOLDER, DUPLICATE_MAX_DISTANCE, HASH_BATCH_SIZE, HASH_WORKERS
+import db.db_funcs as dbf
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+HASH_SIZE = 8 # 8x8 = 64 bits
+UNREADABLE_HASH = -(1 << 63) # Stored for files that can't be hashed, so they are not tried again
+
+
+def compute_dhash(image_path: str) -> int:
+    """
+    Difference hash of an image: each bit tells if a pixel is brighter than its right neighbour in a 9x8 grayscale
+    thumbnail. Resized, recompressed or slightly edited copies get the same hash or one a few bits away.
+    Returned as a signed 64 bit integer, the way sqlite stores it.
+    """
+    pil_img = Image.open(image_path, mode='r')
+    # JPEGs are decoded at 1/8 of their size, plenty for a 9x8 thumbnail
+    pil_img.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+    pil_img = pil_img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.LANCZOS)
+    pixels = list(pil_img.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            value = (value << 1) | (left > pixels[row * (HASH_SIZE + 1) + col + 1])
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def hamming_distance(hash_a: int, hash_b: int) -> int:
+    return bin((hash_a ^ hash_b) & 0xFFFFFFFFFFFFFFFF).count('1')
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes, finds every hash within a hamming distance without comparing to all of them.
+    """
+
+    def __init__(self):
+        self._root = None # [hash, {distance: child node}]
+        self.size = 0
+
+    def add(self, value: int):
+        if self._root is None:
+            self._root = [value, {}]
+            self.size += 1
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = [value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def search(self, value: int, max_distance: int) -> list[tuple[int, int]]:
+        """
+        Get the (hash, distance) of every hash within max_distance of value.
+        """
+        found = []
+        nodes = [self._root] if self._root is not None else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                found.append((node[0], distance))
+            # Triangle inequality: only children at a distance in [d - max, d + max] can be close enough
+            for child_distance, child in node[1].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return found
+
+
+class _IndexSnapshot:
+    """
+    Hashes of one build of the index, never changed once built, so readers see a consistent set without locking.
+    """
+
+    def __init__(self, hashes: dict[str, int]):
+        self.hashes = hashes # name -> phash
+        self.names_by_hash = {} # phash -> names
+        self.tree = BKTree()
+        for name, phash in hashes.items():
+            self.names_by_hash.setdefault(phash, []).append(name)
+            self.tree.add(phash)
+
+    def find_duplicates(self, name: str, max_distance: int) -> list[str]:
+        phash = self.hashes.get(name)
+        if phash is None:
+            return []
+        return [other for found_hash, _ in self.tree.search(phash, max_distance) for other in self.names_by_hash[found_hash]
+                if other != name]
+
+
+class DuplicateIndex:
+    """
+    In-memory index of the perceptual hashes of the input folder, rebuilt when the hashes in the database change.
+    A rebuild publishes a new snapshot, each lookup reads the current one once.
+    """
+
+    def __init__(self, db_filepath: str, max_distance: int = DUPLICATE_MAX_DISTANCE, check_seconds: float = 10):
+        self.db_filepath = db_filepath
+        self.max_distance = max_distance
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._signature = None
+        self._last_check = 0
+        self._snapshot = _IndexSnapshot({})
+        self.builds = 0
+
+    def refresh(self, force: bool = False):
+        """
+        Rebuild the index if the hashes changed, checked at most every check_seconds.
+        """
+        with self._lock:
+            if not force and time.time() - self._last_check < self.check_seconds:
+                return
+            self._last_check = time.time()
+            signature = dbf.get_file_hashes_signature(self.db_filepath)
+            if signature == self._signature:
+                return
+            start = time.time()
+            snapshot = _IndexSnapshot({name: phash for name, phash in dbf.get_file_hashes(self.db_filepath).items()
+                                       if phash != UNREADABLE_HASH})
+            self._snapshot, self._signature = snapshot, signature
+            self.builds += 1
+            logger.info(f'Duplicate index built with {len(snapshot.hashes)} images, {snapshot.tree.size} distinct hashes '
+                        f'in {time.time() - start:.2f}s')
+
+    def find_duplicates(self, name: str, max_distance: int = None) -> list[str]:
+        """
+        Get the images within max_distance of an image, not including itself.
+        """
+        self.refresh()
+        return self._snapshot.find_duplicates(name, self.max_distance if max_distance is None else max_distance)
+
+    def group(self, names: list[str], max_groups: int = None) -> list[list[str]]:
+        """
+        Group the names in clusters of duplicates, in the order of names. The first name of each group
+        is the one to process, the others are its duplicates in names. Images without hash are alone.
+        """
+        self.refresh()
+        snapshot = self._snapshot
+        remaining = set(names)
+        groups = []
+        for name in names:
+            if name not in remaining:
+                continue
+            members = [name] + [other for other in snapshot.find_duplicates(name, self.max_distance) if other in remaining]
+            remaining.difference_update(members)
+            groups.append(members)
+            if max_groups is not None and len(groups) >= max_groups:
+                break
+        return groups
+
+    def stats(self) -> dict:
+        snapshot = self._snapshot
+        duplicated = sum(len(names) for names in snapshot.names_by_hash.values() if len(names) > 1)
+        return {'images': len(snapshot.hashes), 'distinct_hashes': snapshot.tree.size, 'images_with_identical_hash': duplicated,
+                'max_distance': self.max_distance, 'builds': self.builds}
+
+
+def hash_pending_files(db_filepath: str, limit: int = HASH_BATCH_SIZE, workers: int = HASH_WORKERS) -> int:
+    """
+    Compute the hashes of up to limit indexed files that don't have one. Return the amount hashed.
+    """
+    names = dbf.get_unhashed_files(db_filepath, limit)
+    if not names:
+        return 0
+
+    def hash_one(name):
+        try:
+            return name, compute_dhash(INPUT_IMAGE_FOLDER + '/' + name)
+        except Exception as _:
+            logger.warning(f'Could not hash image: {name}')
+            return name, UNREADABLE_HASH
+
+    # PIL releases the GIL while decoding
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='phash') as executor:
+        hashes = list(executor.map(hash_one, names))
+    dbf.set_file_hashes(db_filepath, hashes)
+    return len(hashes)
+
+
+duplicate_index = DuplicateIndex(db_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the perceptual hashes of the input folder and report the duplicates')
+    parser.add_argument('--batch', type=int, default=HASH_BATCH_SIZE)
+    args = parser.parse_args()
+    dbf.initialize_db(db_file)
+    start = time.time()
+    total = 0
+    while True:
+        hashed = hash_pending_files(db_file, limit=args.batch)
+        if not hashed:
+            break
+        total += hashed
+        logger.info(f'{total} images hashed, {total / (time.time() - start):.1f} images/s')
+    duplicate_index.refresh(force=True)
+    print(duplicate_index.stats())
@@ -0,0 +1,238 @@
+import errno
+import itertools
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from settings.config import log_config, INPUT_IMAGE_FOLDER, SESSION_OUTPUT_FOLDER, EXPORT_MODE, EXPORT_WORKERS
+import db.db_funcs as dbf
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+EXPORT_MODES = ['copy', 'hardlink', 'reflink']
+FICLONE = 0x40049409 # ioctl to share the data blocks of a file on btrfs/xfs
+
+
+def get_export_files(db_filepath: str, session_id: int) -> list[tuple[str, str]]:
+    """
+    Get the (source, relative destination) of every labeled image of a session and its .json metadata file.
+    """
+    files = []
+    for image in dbf.get_imgs_from_session(db_filepath, session_id):
+        if not image['label']:
+            continue
+        files.append((INPUT_IMAGE_FOLDER + '/' + image['name'], image['label'] + '/' + image['name']))
+        # check if metadata file exists in input folder
+        if os.path.exists(INPUT_IMAGE_FOLDER + '/' + image['name'] + '.json'):
+            files.append((INPUT_IMAGE_FOLDER + '/' + image['name'] + '.json', image['label'] + '/' + image['name'] + '.json'))
+    return files
+
+def is_unchanged(src: str, dst: str) -> bool:
+    """
+    Check if dst is already an up to date export of src.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except FileNotFoundError:
+        return False
+    src_stat = os.stat(src)
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True # Hardlink to the same file
+    # copy2 keeps the mtime of the source
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+def _reflink(src: str, dst: str):
+    import fcntl # Not available on windows, the caller falls back to a copy
+    tmp_dst = dst + '.tmp'
+    with open(src, 'rb') as fsrc, open(tmp_dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, tmp_dst)
+    os.replace(tmp_dst, dst)
+
+def export_file(src: str, dst: str, mode: str = 'copy') -> str:
+    """
+    Export src to dst with the given mode. Return the mode actually used.
+    """
+    if mode == 'hardlink':
+        try:
+            if os.path.exists(dst):
+                os.remove(dst)
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as e:
+            # Different filesystem or links not supported
+            logger.debug(f'Hardlink not possible, copying {src}: {e}')
+    elif mode == 'reflink':
+        try:
+            _reflink(src, dst)
+            return 'reflink'
+        except (OSError, ImportError) as e:
+            if os.path.exists(dst + '.tmp'):
+                os.remove(dst + '.tmp')
+            if isinstance(e, OSError) and e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY):
+                raise
+    shutil.copy2(src, dst)
+    return 'copy'
+
+
+class ExportJob:
+    """
+    Export of the labeled images of a session to SESSION_OUTPUT_FOLDER/S<session_id>/<label>, done by a thread pool.
+    Files that are already up to date are skipped, so a rerun only exports new or changed images.
+    """
+
+    def __init__(self, job_id: int, db_filepath: str, session_id: int, mode: str = EXPORT_MODE, workers: int = EXPORT_WORKERS):
+        if mode not in EXPORT_MODES:
+            raise ValueError(f"Unknown export mode: {mode}")
+        self.job_id = job_id
+        self.db_filepath = db_filepath
+        self.session_id = session_id
+        self.mode = mode
+        self.workers = workers
+        self.output_folder = SESSION_OUTPUT_FOLDER + '/S' + str(session_id)
+        self.status = 'queued'
+        self.total = 0
+        self.exported = 0
+        self.skipped = 0
+        self.failed = []
+        self.bytes = 0
+        self.modes_used = {}
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            files = get_export_files(self.db_filepath, self.session_id)
+            self.total = len(files)
+            # Create subfolders for each class
+            for folder in set(os.path.dirname(dst) for _, dst in files):
+                os.makedirs(self.output_folder + '/' + folder, exist_ok=True)
+
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'export-{self.job_id}') as executor:
+                list(executor.map(self._export_one, files))
+            self.status = 'finished' if not self.failed else 'finished_with_errors'
+        except Exception as _:
+            logger.error(f'Export {self.job_id} failed', exc_info=True)
+            self.status = 'failed'
+        self.finished = time.time()
+        logger.info(f'Export {self.job_id} of session {self.session_id}: {self.exported} exported, {self.skipped} skipped, '
+                    f'{len(self.failed)} failed in {self.finished - self.started:.1f}s')
+
+    def _export_one(self, file: tuple[str, str]):
+        src, relative_dst = file
+        dst = self.output_folder + '/' + relative_dst
+        try:
+            if is_unchanged(src, dst):
+                with self._lock:
+                    self.skipped += 1
+                return
+            mode_used = export_file(src, dst, self.mode)
+            size = os.path.getsize(src)
+            with self._lock:
+                self.exported += 1
+                self.bytes += size
+                self.modes_used[mode_used] = self.modes_used.get(mode_used, 0) + 1
+        except Exception as e:
+            logger.error(f'Error exporting {src}', exc_info=True)
+            with self._lock:
+                self.failed.append({'image_path': src, 'error': str(e)})
+
+    def progress(self) -> dict:
+        """
+        Get the state and counters of the export.
+        """
+        with self._lock:
+            done = self.exported + self.skipped + len(self.failed)
+            elapsed = ((self.finished or time.time()) - self.started) if self.started else 0
+            return {'job_id': self.job_id, 'session_id': self.session_id, 'mode': self.mode, 'status': self.status,
+                    'total': self.total, 'done': done, 'exported': self.exported, 'skipped': self.skipped,
+                    'failed': list(self.failed), 'bytes': self.bytes, 'modes_used': dict(self.modes_used),
+                    'seconds': round(elapsed, 2), 'output_folder': self.output_folder}
+
+
+class ExportManager:
+    """
+    Runs the exports in background threads and keeps their progress in memory.
+    """
+
+    def __init__(self, db_filepath: str):
+        self.db_filepath = db_filepath
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, session_id: int, mode: str = EXPORT_MODE) -> int:
+        """
+        Start an export of the session and return its id.
+        """
+        with self._lock:
+            running = [job for job in self._jobs.values() if job.session_id == session_id and job.status in ('queued', 'running')]
+            if running:
+                return running[0].job_id
+            job = ExportJob(next(self._ids), self.db_filepath, session_id, mode=mode)
+            self._jobs[job.job_id] = job
+        threading.Thread(target=job.run, name=f'export-job-{job.job_id}', daemon=True).start()
+        return job.job_id
+
+    def status(self, job_id: int) -> dict:
+        """
+        Get the progress of an export, None if it doesn't exist.
+        """
+        job = self._jobs.get(job_id)
+        return job.progress() if job else None
+
+
+class _ChunkWriter:
+    """
+    Write only file object that keeps the written bytes until they are taken, used to stream archives.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_archive(db_filepath: str, session_id: int, archive_format: str = 'tar'):
+    """
+    Generate a tar or zip archive of the labeled images of a session chunk by chunk, without writing it to disk.
+    """
+    files = get_export_files(db_filepath, session_id)
+    writer = _ChunkWriter()
+    if archive_format == 'zip':
+        # Images are already compressed, storing them is much faster
+        with zipfile.ZipFile(writer, mode='w', compression=zipfile.ZIP_STORED) as archive:
+            for src, relative_dst in files:
+                archive.write(src, arcname=relative_dst)
+                yield writer.take()
+    else:
+        with tarfile.open(fileobj=writer, mode='w|') as archive:
+            for src, relative_dst in files:
+                archive.add(src, arcname=relative_dst)
+                yield writer.take()
+    yield writer.take()
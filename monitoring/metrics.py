@@ -0,0 +1,189 @@
+import bisect
+import threading
+import time
+from contextlib import nullcontext
+
+from settings.config import METRICS_ENABLED
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_request = threading.local() # Stage timings of the request served by the current thread
+_NO_SPAN = nullcontext()
+
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"'.replace('\n', ' ') for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """
+    Monotonic counter with optional labels.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    """
+    Histogram of durations in seconds with optional labels.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {} # labels -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    le_label = 'le="' + str(bound) + '"'
+                    lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, key, le_label)} {cumulative}')
+                lines.append(f'{self.name}_sum{_format_labels(self.labelnames, key)} {total}')
+                lines.append(f'{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Metrics of the process, rendered in the Prometheus text format.
+    Collectors are called when rendering, to export counters kept elsewhere (e.g. the cache stats).
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, name: str, documentation: str, metric_type: str, labelnames: tuple, collect):
+        """
+        Add a metric whose samples are returned by collect() as a list of (label values, value).
+        """
+        self._collectors.append((name, documentation, metric_type, tuple(labelnames), collect))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, documentation, metric_type, labelnames, collect in self._collectors:
+            lines.extend([f'# HELP {name} {documentation}', f'# TYPE {name} {metric_type}'])
+            for key, value in collect():
+                if value is not None:
+                    lines.append(f'{name}{_format_labels(labelnames, key)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+request_latency = registry.histogram('img_classifier_request_seconds', 'Latency of the API requests', ('endpoint', 'method', 'status'))
+stage_latency = registry.histogram('img_classifier_stage_seconds', 'Time spent in each stage of the hot paths', ('stage',))
+predictions_total = registry.counter('img_classifier_predictions_total', 'Images predicted')
+decode_failures_total = registry.counter('img_classifier_decode_failures_total', 'Images that could not be decoded')
+
+
+class _Span:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        stage_latency.observe(elapsed, stage=self.stage)
+        timings = getattr(_request, 'timings', None)
+        if timings is not None:
+            timings[self.stage] = timings.get(self.stage, 0) + elapsed
+        return False
+
+
+def span(stage: str):
+    """
+    Time a block of code as a stage of the hot paths. Does nothing when the metrics are disabled.
+    """
+    if not METRICS_ENABLED:
+        return _NO_SPAN
+    return _Span(stage)
+
+def inc(counter: Counter, amount: float = 1, **labels):
+    """
+    Increment a counter if the metrics are enabled.
+    """
+    if METRICS_ENABLED:
+        counter.inc(amount, **labels)
+
+
+def start_request():
+    """
+    Start collecting the stage timings of the request served by this thread.
+    """
+    _request.start = time.perf_counter()
+    _request.timings = {}
+
+def finish_request(endpoint: str, method: str, status: int) -> dict[str, float]:
+    """
+    Record the latency of the request and return its stage timings in seconds, including the total.
+    """
+    timings = getattr(_request, 'timings', None)
+    if timings is None:
+        return {}
+    timings['total'] = time.perf_counter() - _request.start
+    _request.timings = None
+    request_latency.observe(timings['total'], endpoint=endpoint, method=method, status=status)
+    return timings
+
+def server_timing_header(timings: dict[str, float]) -> str:
+    """
+    Format the stage timings as a Server-Timing header, in ms.
+    """
+    return ', '.join(f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in timings.items())
+
+def render() -> str:
+    return registry.render()
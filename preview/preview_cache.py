@@ -0,0 +1,211 @@
+import glob
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from settings.config import log_config, PREVIEW_WIDTH, PREVIEW_CACHE_FOLDER, PREVIEW_CACHE_MAX_BYTES
+from monitoring.metrics import span
+
+import logging
+from logging import config as logging_config
+logging_config.dictConfig(log_config)
+logger = logging.getLogger()
+
+
+def create_preview(image_path: str, base_width: int = PREVIEW_WIDTH) -> tuple[bytes, str]:
+    """
+    Scale the image to base_width keeping its aspect ratio and encode it in its original format.
+    Return the encoded bytes and the format.
+    """
+    pil_img = Image.open(image_path, mode='r') # reads the PIL image
+    img_format = pil_img.format
+
+    wpercent = (base_width / float(pil_img.size[0]))
+    hsize = int((float(pil_img.size[1]) * float(wpercent)))
+
+    # JPEGs can be decoded at a reduced scale (1/2, 1/4, 1/8) that is still bigger than the preview
+    with span('preview_resize'):
+        if img_format == 'JPEG':
+            pil_img.draft(pil_img.mode, (base_width, hsize))
+        pil_img = pil_img.resize((base_width, hsize), Image.Resampling.LANCZOS)
+
+    byte_arr = io.BytesIO()
+    with span('preview_encode'):
+        pil_img.save(byte_arr, format=img_format) # convert the PIL image to byte array
+    return byte_arr.getvalue(), img_format
+
+
+def get_preview_mimetype(img_format: str) -> str:
+    """
+    Get the mimetype of a PIL image format.
+    """
+    return Image.MIME.get(img_format.upper(), 'application/octet-stream')
+
+
+class PreviewCache:
+    """
+    Size bounded LRU cache of image previews on disk, keyed by the image path plus its mtime and size.
+    """
+
+    def __init__(self, cache_folder: str = PREVIEW_CACHE_FOLDER, max_bytes: int = PREVIEW_CACHE_MAX_BYTES, workers: int = 2):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None # Computed lazily from the folder
+        self._pending = set() # Paths being generated in the background
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview')
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_prefix(self, image_path: str) -> str:
+        path_hash = hashlib.sha1(os.path.abspath(image_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_folder, path_hash[:2], path_hash)
+
+    def _entry_path(self, image_path: str, img_format: str = '*') -> str:
+        stat = os.stat(image_path)
+        return f'{self._entry_prefix(image_path)}_{stat.st_mtime_ns}_{stat.st_size}.{img_format}'
+
+    def find(self, image_path: str) -> str:
+        """
+        Get the path of the cached preview of an image, or None if it's not cached.
+        """
+        matches = glob.glob(self._entry_path(image_path))
+        if not matches:
+            return None
+        try:
+            os.utime(matches[0]) # Keeps the least recently used order for the eviction
+        except FileNotFoundError:
+            return None
+        return matches[0]
+
+    def get(self, image_path: str) -> tuple[bytes, str]:
+        """
+        Get the preview bytes and format of an image, creating and caching it if needed.
+        """
+        entry_path = self.find(image_path)
+        if entry_path is not None:
+            try:
+                with open(entry_path, 'rb') as f:
+                    data = f.read()
+                self.hits += 1
+                return data, entry_path.rsplit('.', 1)[1]
+            except FileNotFoundError:
+                pass # Evicted meanwhile
+        self.misses += 1
+        data, img_format, _ = self._create(image_path)
+        return data, img_format
+
+    def get_path(self, image_path: str) -> tuple[str, str]:
+        """
+        Get the path and format of the cached preview of an image, creating it if needed.
+        """
+        entry_path = self.find(image_path)
+        if entry_path is None:
+            self.misses += 1
+            # The path written is used as is, a search could miss it while another thread recreates the preview
+            _, _, entry_path = self._create(image_path)
+        else:
+            self.hits += 1
+        return entry_path, entry_path.rsplit('.', 1)[1]
+
+    def _create(self, image_path: str) -> tuple[bytes, str, str]:
+        """
+        Create and cache the preview of an image. Return its bytes, format and path.
+        """
+        data, img_format = create_preview(image_path)
+        entry_path = self._entry_path(image_path, img_format)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+
+        # Stale previews of the same image are removed, not the current one another thread may be serving
+        for stale_path in glob.glob(f'{self._entry_prefix(image_path)}_*'):
+            if stale_path.endswith('.tmp') or stale_path == entry_path:
+                continue
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+
+        tmp_path = f'{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, entry_path)
+
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += len(data)
+        self._evict_if_needed()
+        return data, img_format, entry_path
+
+    def pregenerate(self, image_paths: list[str]):
+        """
+        Create the previews of the given images in the background.
+        """
+        for image_path in image_paths:
+            with self._lock:
+                if image_path in self._pending:
+                    continue
+                self._pending.add(image_path)
+            self._executor.submit(self._pregenerate_one, image_path)
+
+    def _pregenerate_one(self, image_path: str):
+        try:
+            if self.find(image_path) is None:
+                self._create(image_path)
+        except Exception as _:
+            logger.error(f'Could not create preview: {image_path}', exc_info=True)
+        finally:
+            with self._lock:
+                self._pending.discard(image_path)
+
+    def _list_entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for entry_path in glob.glob(os.path.join(self.cache_folder, '*', '*')):
+            if entry_path.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(entry_path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+        return entries
+
+    def _evict_if_needed(self):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._list_entries())
+            if self._total_bytes <= self.max_bytes:
+                return
+
+            # Remove the least recently used previews until the cache is at 90% of its size
+            entries = sorted(self._list_entries())
+            total_bytes = sum(size for _, size, _ in entries)
+            target_bytes = int(self.max_bytes * 0.9)
+            for _, size, entry_path in entries:
+                if total_bytes <= target_bytes:
+                    break
+                try:
+                    os.remove(entry_path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+            self._total_bytes = total_bytes
+
+    def shutdown(self):
+        """
+        Stop the background workers.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        """
+        Get the hit/miss counters and the size of the cache.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size_bytes': self._total_bytes, 'max_bytes': self.max_bytes,
+                    'pending': len(self._pending)}
+
+
+preview_cache = PreviewCache()
@@ -17,6 +17,104 @@ INPUT_IMAGE_FOLDER = VOLUME_PATH + 'data/images/input'
 SESSION_OUTPUT_FOLDER = VOLUME_PATH + 'data/images/output'
 CLS_MODEL_FOLDER = VOLUME_PATH + 'data/models'
 
+# Seconds a connection waits for a lock held by another connection
+DB_BUSY_TIMEOUT_SECONDS = float(os.getenv('DB_BUSY_TIMEOUT_SECONDS', '10'))
+# Page cache of each sqlite connection in KiB
+DB_CACHE_SIZE_KB = int(os.getenv('DB_CACHE_SIZE_KB', '20000'))
+
+# Seconds between checks of the input folder for new or removed images, 0 disables watching
+INDEX_POLL_SECONDS = float(os.getenv('INDEX_POLL_SECONDS', '5'))
+# Files modified in place don't change the folder mtime, so the folder is fully rescanned from time to time
+INDEX_FULL_RESCAN_SECONDS = float(os.getenv('INDEX_FULL_RESCAN_SECONDS', '300'))
+
+# Maximum amount of keras models kept in memory at the same time
+MODEL_CACHE_SIZE = int(os.getenv('MODEL_CACHE_SIZE', '4'))
+# Published model versions of each session, the served one and the newest MODEL_REGISTRY_KEEP are kept
+MODEL_REGISTRY_FOLDER = CLS_MODEL_FOLDER + '/registry'
+MODEL_REGISTRY_KEEP = int(os.getenv('MODEL_REGISTRY_KEEP', '5'))
+# Amount of images sent to the model at once when predicting
+PREDICT_BATCH_SIZE = int(os.getenv('PREDICT_BATCH_SIZE', '16'))
+
+# Serving artifacts written after each model save: savedmodel, tflite_float16, tflite_int8 (comma separated)
+SERVING_EXPORT_FORMATS = [fmt.strip() for fmt in os.getenv('SERVING_EXPORT_FORMATS', 'savedmodel').split(',') if fmt.strip()]
+# Format used for predictions: keras, savedmodel, tflite_float16, tflite_int8 or auto (fastest one that agrees with keras)
+SERVING_FORMAT = os.getenv('SERVING_FORMAT', 'auto')
+# Minimum fraction of predictions equal to the keras model for auto to pick an artifact
+SERVING_MIN_AGREEMENT = float(os.getenv('SERVING_MIN_AGREEMENT', '0.99'))
+# Labeled images of the session used to calibrate the int8 quantization, and as many to evaluate the artifacts
+SERVING_CALIBRATION_IMAGES = int(os.getenv('SERVING_CALIBRATION_IMAGES', '100'))
+
+# On-disk cache of decoded and resized images shared by training and inference
+TENSOR_CACHE_ENABLED = os.getenv('TENSOR_CACHE_ENABLED', 'True') == 'True'
+TENSOR_CACHE_FOLDER = VOLUME_PATH + 'data/cache/tensors'
+TENSOR_CACHE_MAX_BYTES = int(os.getenv('TENSOR_CACHE_MAX_BYTES', str(2 * 1024**3)))
+
+# Training input pipeline: TRAIN_DATASET_CACHE can be '' (no cache), 'memory' or a file path prefix
+TRAIN_DATASET_CACHE = os.getenv('TRAIN_DATASET_CACHE', 'memory')
+# Above this many images the 'memory' cache is skipped, it holds 192 KB per image
+TRAIN_MEMORY_CACHE_MAX_IMAGES = int(os.getenv('TRAIN_MEMORY_CACHE_MAX_IMAGES', '5000'))
+TRAIN_VALIDATION_SPLIT = float(os.getenv('TRAIN_VALIDATION_SPLIT', '0.2'))
+TRAIN_SEED = int(os.getenv('TRAIN_SEED', '42'))
+# Training stops when EARLY_STOPPING_MONITOR didn't improve by EARLY_STOPPING_MIN_DELTA for EARLY_STOPPING_PATIENCE
+# epochs, or after TRAIN_MAX_EPOCHS, and keeps the best weights. Each epoch is checkpointed so an interrupted job resumes.
+TRAIN_MAX_EPOCHS = int(os.getenv('TRAIN_MAX_EPOCHS', '25'))
+EARLY_STOPPING_MONITOR = os.getenv('EARLY_STOPPING_MONITOR', 'val_loss')
+EARLY_STOPPING_PATIENCE = int(os.getenv('EARLY_STOPPING_PATIENCE', '3'))
+EARLY_STOPPING_MIN_DELTA = float(os.getenv('EARLY_STOPPING_MIN_DELTA', '0.001'))
+TRAIN_CHECKPOINT_FOLDER = CLS_MODEL_FOLDER + '/checkpoints'
+# Incremental training: the new labels are mixed with up to REPLAY_BUFFER_SIZE older labeled images, balanced by class
+REPLAY_BUFFER_SIZE = int(os.getenv('REPLAY_BUFFER_SIZE', '1024'))
+INCREMENTAL_EPOCHS = int(os.getenv('INCREMENTAL_EPOCHS', '5'))
+
+# Scaled down copies of the images shown in the labeling UI
+PREVIEW_WIDTH = 1000
+PREVIEW_CACHE_FOLDER = VOLUME_PATH + 'data/cache/previews'
+PREVIEW_CACHE_MAX_BYTES = int(os.getenv('PREVIEW_CACHE_MAX_BYTES', str(512 * 1024**2)))
+# Amount of upcoming images in the prediction queue whose previews are generated in the background
+PREVIEW_PREGENERATE_AMOUNT = int(os.getenv('PREVIEW_PREGENERATE_AMOUNT', '5'))
+# 'base64' embeds the preview in the json responses, 'url' returns a link to /api/preview instead
+IMAGE_RESPONSE_MODE = os.getenv('IMAGE_RESPONSE_MODE', 'base64')
+PREVIEW_MAX_AGE_SECONDS = int(os.getenv('PREVIEW_MAX_AGE_SECONDS', str(365 * 24 * 3600)))
+
+# Export of the labeled images: 'copy', 'hardlink' or 'reflink' (both fall back to a copy when not possible)
+EXPORT_MODE = os.getenv('EXPORT_MODE', 'copy')
+EXPORT_WORKERS = int(os.getenv('EXPORT_WORKERS', '8'))
+
+# Head only training on embeddings of a frozen feature extractor.
+# BACKBONE_WEIGHTS_FILE is an optional keras model taking 256x256x3 images scaled to [0, 1], when empty the
+# layers of the session model below its output layer are used.
+BACKBONE_WEIGHTS_FILE = os.getenv('BACKBONE_WEIGHTS_FILE', '')
+EMBEDDING_CACHE_FOLDER = VOLUME_PATH + 'data/cache/embeddings'
+HEAD_EPOCHS = int(os.getenv('HEAD_EPOCHS', '30'))
+
+# Near duplicate images, found by the hamming distance of their perceptual hashes (64 bits)
+DEDUP_ENABLED = os.getenv('DEDUP_ENABLED', 'True') == 'True'
+DUPLICATE_MAX_DISTANCE = int(os.getenv('DUPLICATE_MAX_DISTANCE', '4'))
+# Give the label of an image to its unlabeled duplicates within DUPLICATE_PROPAGATE_DISTANCE (0: identical hashes)
+DUPLICATE_LABEL_PROPAGATION = os.getenv('DUPLICATE_LABEL_PROPAGATION', 'False') == 'True'
+DUPLICATE_PROPAGATE_DISTANCE = int(os.getenv('DUPLICATE_PROPAGATE_DISTANCE', '0'))
+# Train with a single image of each group of duplicates with the same label
+TRAIN_DEDUPLICATE = os.getenv('TRAIN_DEDUPLICATE', 'False') == 'True'
+# Hashes computed by the folder indexer on each poll, and threads used
+HASH_BATCH_SIZE = int(os.getenv('HASH_BATCH_SIZE', '2000'))
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', '4'))
+
+# Background prediction prefetching: keep at least PREFETCH_WATERMARK unlabeled predictions per active session
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'True') == 'True'
+PREFETCH_WATERMARK = int(os.getenv('PREFETCH_WATERMARK', '20'))
+PREFETCH_REFILL_AMOUNT = int(os.getenv('PREFETCH_REFILL_AMOUNT', '50'))
+PREFETCH_POLL_SECONDS = float(os.getenv('PREFETCH_POLL_SECONDS', '2'))
+# A session stops being prefetched when it had no requests for this long
+PREFETCH_SESSION_TTL_SECONDS = float(os.getenv('PREFETCH_SESSION_TTL_SECONDS', '600'))
+
+# Tensorflow is imported on the first training or prediction, set to True to load it in the background after boot instead
+CLASSIFIER_WARMUP = os.getenv('CLASSIFIER_WARMUP', 'False') == 'True'
+
+# Latency histograms, stage timings and counters exposed at /api/metrics in the Prometheus text format
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+# Adds a Server-Timing header with the time of each stage to the API responses
+TIMING_HEADER_ENABLED = os.getenv('TIMING_HEADER_ENABLED', 'False') == 'True'
+
 # Nice guide to logging config with dictionary
 # https://coderzcolumn.com/tutorials/python/logging-config-simple-guide-to-configure-loggers-from-dictionary-and-config-files-in-python
 logging_level = 'INFO'